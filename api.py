@@ -1,126 +1,502 @@
+import json
+import logging
 import os
-from flask import Flask, request, abort, jsonify
+import threading
+import time
+from urllib.parse import urlencode
+from flask import (Flask, Response, request, abort, g, jsonify,
+                   stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from models import setup_database, Artists, Movies
+from models import (setup_database, read_only, fresh_reads, engines,
+                    get_page, decode_cursor, iter_rows, validate,
+                    bulk_insert, bulk_update, bulk_delete, get_cast,
+                    get_row, update_row, existing_ids, iter_changes,
+                    get_filmography, get_counts_page, summary_of,
+                    Artists, Movies, Performances,
+                    DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, STREAM_BATCH_SIZE,
+                    MAX_BATCH_SIZE)
+import events
+import transfer
 from auth import AuthError, requires_auth
+from ratelimit import LimitExceeded
+from cache import response_cache
+from compress import compress_response, decoded_etag
+from fastjson import JSONEncoder, dumps
+from metrics import (CONTENT_TYPE, PHASES, instrument_queries, phase,
+                     pool_metrics, render, request_latency, server_timing)
+
+NDJSON = 'application/x-ndjson'
+
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '1') != '0'
+REQUEST_LOG = os.environ.get('REQUEST_LOG', '0') != '0'
+
+logger = logging.getLogger(__name__)
+
+
+class TimedJSONEncoder(JSONEncoder):
+    '''
+    The JSON encoder of jsonify, timed as the serialize phase of the
+    request.
+    '''
+
+    def encode(self, o):
+        with phase('serialize'):
+            return super().encode(o)
+
+
+def record_request(response):
+    '''
+    Adds the Server-Timing header, observes the latency of the route and
+    logs the request as one JSON line. Streamed bodies are still being
+    generated at this point and are not part of the timings.
+    '''
+    total = time.perf_counter() - g.started_at
+    timings = g.get('timings', {})
+    queries = g.get('queries', 0)
+    rows = g.get('rows', 0)
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    request_latency.observe(total, method=request.method, route=route)
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = server_timing(
+            timings, total, queries, rows)
+    if logger.isEnabledFor(logging.INFO):
+        record = {
+            'method': request.method,
+            'route': route,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round(total * 1000, 3),
+            'queries': queries,
+            'rows': rows
+        }
+        for name in PHASES:
+            record[f'{name}_ms'] = round(timings.get(name, 0) * 1000, 3)
+        logger.info(json.dumps(record))
+
+
+def get_page_args(model, args=None, default_sort='id', field_names=None):
+    '''
+    Reads the limit, after, fields, sort and filter arguments of a list
+    request. limit is capped at MAX_PAGE_SIZE, anything malformed is a 400.
+    `fields` may name any of `field_names`, model.FIELDS by default.
+    '''
+    if args is None:
+        args = request.args
+
+    sort = args.get('sort', default_sort)
+    if sort.lstrip('-') not in model.SORTS:
+        abort(400)
+
+    try:
+        limit = int(args.get('limit', DEFAULT_PAGE_SIZE))
+        after = args.get('after')
+        after = decode_cursor(model, sort, after) if after else None
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    fields = args.get('fields')
+    if fields:
+        fields = tuple(field.strip() for field in fields.split(','))
+        if not set(fields) <= set(field_names or model.FIELDS):
+            abort(400)
+    else:
+        fields = None
+
+    filters = {}
+    for name, (field, operator) in model.FILTERS.items():
+        value = args.get(name)
+        if value is None:
+            continue
+        python_type = model.__table__.c[field].type.python_type
+        try:
+            filters[name] = python_type(value)
+        except ValueError:
+            abort(400)
+    return after, limit, fields, filters, sort
+
+
+def wants_stream(args=None, accept=None):
+    '''
+    Whether a list is asked for as NDJSON, with ?stream=1 or an Accept
+    header ranking it above JSON. The query arguments and the parsed
+    Accept header are those of the current request unless given.
+    '''
+    if args is None:
+        args, accept = request.args, request.accept_mimetypes
+    if args.get('stream') in ('1', 'true'):
+        return True
+    return accept.best_match(['application/json', NDJSON]) == NDJSON
+
+
+def ndjson_response(rows, table=None):
+    '''
+    Streams rows as newline delimited JSON, one chunk per
+    STREAM_BATCH_SIZE rows, so the whole list is never held in memory.
+    The rows are read while the response is sent, from the primary if
+    `table` was just written.
+    '''
+    def generate():
+        with fresh_reads(table):
+            lines = []
+            for row in rows:
+                lines.append(dumps(row))
+                if len(lines) >= STREAM_BATCH_SIZE:
+                    yield '\n'.join(lines) + '\n'
+                    lines = []
+            if lines:
+                yield '\n'.join(lines) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON)
+
+
+def version_tag(version):
+    return f'v{version}'
+
+
+def matched_etag(tag):
+    '''
+    The tag of If-None-Match naming `tag`, or the tag of its compressed
+    body, None if none does.
+    '''
+    if request.if_none_match.star_tag:
+        return tag
+    return next((sent for sent in request.if_none_match.as_set(
+        include_weak=True) if decoded_etag(sent) == tag), None)
+
+
+def not_modified(tag):
+    '''
+    304 Not Modified carrying the tag the client sent, so a client
+    holding a compressed body keeps its encoded tag.
+    '''
+    response = Response(status=304)
+    response.set_etag(tag)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def cached_response(key, table, build, generation=None, etag=None):
+    '''
+    Serves a JSON body from the response cache, building and caching it
+    on a miss. Answers If-None-Match with 304 Not Modified. The ETag is
+    a hash of the body unless `etag` derives it from the built data.
+    '''
+    if generation is None:
+        generation = response_cache.generation(table)
+    entry = response_cache.get(key)
+    if entry is None:
+        with fresh_reads(table):
+            data = build()
+        with phase('serialize'):
+            body = dumps(data, sort_keys=True)
+        entry = response_cache.set(key, body, table, generation,
+                                   etag and etag(data))
+    body, tag = entry
+    sent = matched_etag(tag)
+    if sent is not None:
+        return not_modified(sent)
+    response = Response(body, mimetype='application/json')
+    response.set_etag(tag)
+    return response
+
+
+def cached_entity(model, id, name):
+    '''
+    Serves one row from the response cache, tagged with its version so
+    the ETag can be sent back in If-Match.
+    '''
+    def build():
+        row = get_row(model, id)
+        if row is None:
+            abort(404)
+        return {'success': True, name: row}
+    table = model.__tablename__
+    generation = response_cache.generation(table)
+    return cached_response(
+        response_cache.entity_key(table, id, generation), table, build,
+        generation, etag=lambda data: version_tag(data[name]['version']))
+
+
+def cached_list(model, build):
+    '''
+    Serves a list page. With a shared cache backend it is tagged with
+    the generation of its table, so a matching If-None-Match is answered
+    before the cache or the database is read, otherwise with a hash of
+    its body.
+    '''
+    args = urlencode(sorted(request.args.items(multi=True)))
+    table = model.__tablename__
+    generation = response_cache.generation(table)
+    tag = response_cache.list_etag(table, args, generation)
+    sent = tag and matched_etag(tag)
+    if sent is not None:
+        return not_modified(sent)
+    key = response_cache.list_key(table, args, generation)
+    return cached_response(key, table, build, generation,
+                           etag=tag and (lambda data: tag))
+
+
+def if_match_versions():
+    '''
+    Versions named by the If-Match header, None without the header or
+    for If-Match: *. Tags other than "v<version>" never match.
+    '''
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    tags = {decoded_etag(tag) for tag in request.if_match.as_set()}
+    return {int(tag[1:]) for tag in tags
+            if tag[:1] == 'v' and tag[1:].isdigit()}
+
+
+def counts_page(model, name):
+    '''
+    A page of movies or artists with their cast or film count, most
+    first unless sorted otherwise.
+    '''
+    summary = summary_of(model)
+    after, limit, fields, _, sort = get_page_args(
+        summary, default_sort='-' + summary.COUNT,
+        field_names=model.FIELDS + (summary.COUNT,))
+
+    def build():
+        rows, next_cursor = get_counts_page(model, after, limit, sort,
+                                            fields)
+        return {
+            'success': True,
+            name: rows,
+            'next_cursor': next_cursor
+        }
+    return cached_list(summary, build)
+
+
+def update_entity(model, id, name):
+    '''
+    Partial update of one row: fields missing from the body keep their
+    value. With If-Match the row is only updated at the named version,
+    otherwise it is 412 Precondition Failed.
+    '''
+    values = request.get_json(silent=True)
+    if not isinstance(values, dict) or not values or 'id' in values \
+            or validate(model, dict(values, id=id), partial=True):
+        abort(422)
+    versions = if_match_versions()
+    try:
+        row = update_row(model, id, values, versions)
+    except Exception:
+        abort(422)
+    if row is None:
+        found = versions is not None and existing_ids(model, [id])
+        abort(412 if found else 404)
+    response = jsonify({
+        'success': True,
+        f'updated_{name}': row
+        })
+    response.set_etag(version_tag(row['version']))
+    return response
+
+
+def delete_entity(model, id, name):
+    '''
+    Deletes one row with a single DELETE ... RETURNING, or marks it
+    deleted when soft deletes are on.
+    '''
+    try:
+        deleted = bulk_delete(model, [id])
+    except Exception:
+        abort(422)
+    if not deleted:
+        abort(404)
+    return jsonify({
+        'success': True,
+        f'deleted_{name}_id': id
+        })
+
+
+def get_batch():
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not items:
+        abort(422)
+    if len(items) > MAX_BATCH_SIZE:
+        abort(413)
+    return items
+
+
+def invalid_batch(errors):
+    return jsonify({
+        'success': False,
+        'error': 422,
+        'message': 'unprocessable',
+        'errors': errors
+        }), 422
+
+
+def batch_insert(model):
+    items = get_batch()
+    errors = [{'index': index, 'error': error}
+              for index, error in enumerate(
+                  validate(model, item) for item in items) if error]
+    if errors:
+        return invalid_batch(errors)
+    try:
+        ids = bulk_insert(model, items)
+    except Exception:
+        abort(422)
+    return jsonify({
+        'success': True,
+        'results': [{'id': id, 'status': 'created'} for id in ids]
+        })
+
+
+def batch_update(model):
+    items = get_batch()
+    errors = [{'index': index, 'error': error}
+              for index, error in enumerate(
+                  validate(model, item, partial=True) for item in items)
+              if error]
+    if errors:
+        return invalid_batch(errors)
+    try:
+        updated = bulk_update(model, items)
+    except Exception:
+        abort(422)
+    return jsonify({
+        'success': True,
+        'results': [{'id': item['id'],
+                     'status': 'updated' if item['id'] in updated
+                     else 'not_found'} for item in items]
+        })
+
+
+def batch_delete(model):
+    ids = get_batch()
+    errors = [{'index': index, 'error': 'id must be an integer'}
+              for index, id in enumerate(ids)
+              if not isinstance(id, int) or isinstance(id, bool)]
+    if errors:
+        return invalid_batch(errors)
+    try:
+        deleted = bulk_delete(model, ids)
+    except Exception:
+        abort(422)
+    return jsonify({
+        'success': True,
+        'results': [{'id': id,
+                     'status': 'deleted' if id in deleted else 'not_found'}
+                    for id in ids]
+        })
 
 
 def create_app(test_config=None):
-    # create and configure the app
+    '''
+    Builds an app. `test_config` overrides the configuration read from
+    the environment, e.g. SQLALCHEMY_DATABASE_URI.
+    '''
     app = Flask(__name__)
+    app.json_encoder = TimedJSONEncoder
+    if test_config:
+        app.config.from_mapping(test_config)
     setup_database(app)
+    app.cli.add_command(transfer.import_command)
+    app.cli.add_command(transfer.export_command)
     CORS(app)
+    instrument_queries()
+    if REQUEST_LOG and not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+        logger.setLevel(logging.INFO)
 
     def index():
         return jsonify({'message': 'Welcome to the Casting Agency'})
 
+    @app.before_request
+    def before_request():
+        g.started_at = time.perf_counter()
+
     @app.after_request
     def after_request(response):
         response.headers.add('Access-Control-Allow-Headers',
                              'Content-Type, Authorization')
         response.headers.add('Access-Control-Allow-Methods',
                              'GET, POST, DELETE, OPTIONS')
+        compress_response(response, request.headers.get('Accept-Encoding'))
+        record_request(response)
         return response
 
 # GET /artists'
     @app.route('/artists', methods=['GET'])
     @requires_auth('get:artists')
-    def get_all_actors():
-        artists_query = Artists.query.all()
-        artists = [artist.format() for artist in artists_query]
+    @read_only
+    def get_all_actors(payload):
+        after, limit, fields, filters, sort = get_page_args(Artists)
+        if wants_stream():
+            return ndjson_response(
+                iter_rows(Artists, after, fields, filters, sort),
+                Artists.__tablename__)
 
-        if artists_query is None:
-            abort(404)
-        else:
-            return jsonify({
+        def build():
+            artists, next_cursor = get_page(Artists, after, limit, fields,
+                                          filters, sort)
+            return {
                 'success': True,
-                'artists': artists
-            })
+                'artists': artists,
+                'next_cursor': next_cursor
+            }
+        return cached_list(Artists, build)
 
 # GET /artists/<int:artist_id>
     @app.route('/artists/<int:artist_id>', methods=['GET'])
     @requires_auth('get:artist')
-    def get_actor(artist_id):
-        artist = Artists.query.get(artist_id)
-        if artist is None:
-            abort(404)
-        else:
-            artist = artist.format()
-            return jsonify({
-                'success': True,
-                'artist': artist
-                })
+    @read_only
+    def get_actor(payload, artist_id):
+        return cached_entity(Artists, artist_id, 'artist')
 
 # GET movies
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
-    def get_all_movies():
-        movies_query = Movies.query.all()
-        movies = [movie.format() for movie in movies_query]
+    @read_only
+    def get_all_movies(payload):
+        after, limit, fields, filters, sort = get_page_args(Movies)
+        if wants_stream():
+            return ndjson_response(
+                iter_rows(Movies, after, fields, filters, sort),
+                Movies.__tablename__)
 
-        if movies_query is None:
-            abort(404)
-        else:
-            return jsonify({
+        def build():
+            movies, next_cursor = get_page(Movies, after, limit, fields,
+                                          filters, sort)
+            return {
                 'success': True,
-                'movies': movies
-            })
+                'movies': movies,
+                'next_cursor': next_cursor
+            }
+        return cached_list(Movies, build)
 
 # GET movies/id
     @app.route('/movies/<int:movie_id>', methods=['GET'])
     @requires_auth('get:movie')
-    def get_movie(movie_id):
-        movie = Movies.query.get(movie_id)
-        if movie is None:
-            abort(404)
-        else:
-            movie = movie.format()
-            return jsonify({
-                'success': True,
-                'movie': movie
-            })
+    @read_only
+    def get_movie(payload, movie_id):
+        return cached_entity(Movies, movie_id, 'movie')
 
 # DELETE artist/id
     @app.route('/artists/<int:artist_id>', methods=['DELETE'])
     @requires_auth('delete:artist')
-    def delete_artist(artist_id):
-        try:
-            artist_delete = Artists.query.filter_by(id=artist_id).one_or_none()
-            if artist_delete is None:
-                abort(404)
-            else:
-                deleted_artist_id = artist_delete.id
-                artist_delete.delete()
-        except Exception:
-            abort(422)
-        return jsonify({
-            'success': True,
-            'deleted_artist_id': deleted_artist_id
-            })
+    def delete_artist(payload, artist_id):
+        return delete_entity(Artists, artist_id, 'artist')
 
 # DELETE movies/id
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @requires_auth('delete:movie')
-    def delete_movie(movie_id):
-        try:
-            movie_delete = Movies.query.filter_by(id=movie_id).one_or_none()
-            if movie_delete is None:
-                abort(404)
-            else:
-                deleted_movie_id = movie_delete.id
-                movie_delete.delete()
-        except Exception:
-            abort(422)
-        return jsonify({
-            'success': True,
-            'deleted_movie_id': deleted_movie_id
-            })
+    def delete_movie(payload, movie_id):
+        return delete_entity(Movies, movie_id, 'movie')
 
 # POST artists
     @app.route('/artists', methods=['POST'])
     @requires_auth('post:artist')
-    def add_new_artist():
+    def add_new_artist(payload):
         try:
             body = request.get_json()
             name = body.get('name')
@@ -138,7 +514,7 @@ def create_app(test_config=None):
 # POST movies
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movie')
-    def add_new_movie():
+    def add_new_movie(payload):
         try:
             if request.method == 'PUT':
                 abort(405)
@@ -158,54 +534,183 @@ def create_app(test_config=None):
 # PATCH artists/id
     @app.route('/artists/<int:artist_id>', methods=['PATCH'])
     @requires_auth('patch:artist')
-    def update_artist(artist_id):
-        artist = Artists.query.get(artist_id)
-        if artist is None:
-            abort(404)
-        else:
-            try:
-                body = request.get_json()
+    def update_artist(payload, artist_id):
+        return update_entity(Artists, artist_id, 'artist')
+
+# PATCH movies/id
+    @app.route('/movies/<int:movie_id>', methods=['PATCH'])
+    @requires_auth('patch:movie')
+    def update_movie(payload, movie_id):
+        return update_entity(Movies, movie_id, 'movie')
+
+# POST artists:batch
+    @app.route('/artists:batch', methods=['POST'])
+    @requires_auth('post:artist')
+    def add_artists_batch(payload):
+        return batch_insert(Artists)
+
+# POST movies:batch
+    @app.route('/movies:batch', methods=['POST'])
+    @requires_auth('post:movie')
+    def add_movies_batch(payload):
+        return batch_insert(Movies)
+
+# PATCH artists:batch
+    @app.route('/artists:batch', methods=['PATCH'])
+    @requires_auth('patch:artist')
+    def update_artists_batch(payload):
+        return batch_update(Artists)
+
+# PATCH movies:batch
+    @app.route('/movies:batch', methods=['PATCH'])
+    @requires_auth('patch:movie')
+    def update_movies_batch(payload):
+        return batch_update(Movies)
 
-                name = body.get('name')
-                age = body.get('age')
-                gender = body.get('gender')
+# DELETE artists:batch
+    @app.route('/artists:batch', methods=['DELETE'])
+    @requires_auth('delete:artist')
+    def delete_artists_batch(payload):
+        return batch_delete(Artists)
 
-                artist.name = name
-                artist.age = age
-                artist.gender = gender
+# DELETE movies:batch
+    @app.route('/movies:batch', methods=['DELETE'])
+    @requires_auth('delete:movie')
+    def delete_movies_batch(payload):
+        return batch_delete(Movies)
 
-                artist.update()
+# GET movies/cast-counts
+    @app.route('/movies/cast-counts', methods=['GET'])
+    @requires_auth('get:movies')
+    @read_only
+    def get_movie_cast_counts(payload):
+        return counts_page(Movies, 'movies')
+
+# GET artists/film-counts
+    @app.route('/artists/film-counts', methods=['GET'])
+    @requires_auth('get:artists')
+    @read_only
+    def get_artist_film_counts(payload):
+        return counts_page(Artists, 'artists')
+
+# GET movies/id/artists
+    @app.route('/movies/<int:movie_id>/artists', methods=['GET'])
+    @requires_auth('get:movie', 'get:artists')
+    @read_only
+    def get_movie_cast(payload, movie_id):
+        cast = get_cast(movie_id)
+        if cast is None:
+            abort(404)
+        movie, artists = cast
+        return jsonify({
+            'success': True,
+            'movie': movie,
+            'artists': artists
+            })
+
+# GET artists/id/movies
+    @app.route('/artists/<int:artist_id>/movies', methods=['GET'])
+    @requires_auth('get:artist', 'get:movies')
+    @read_only
+    def get_artist_filmography(payload, artist_id):
+        filmography = get_filmography(artist_id)
+        if filmography is None:
+            abort(404)
+        artist, movies = filmography
+        return jsonify({
+            'success': True,
+            'artist': artist,
+            'movies': movies
+            })
+
+# POST movies/id/artists/id
+    @app.route('/movies/<int:movie_id>/artists/<int:artist_id>',
+               methods=['POST'])
+    @requires_auth('patch:movie')
+    def assign_artist(payload, movie_id, artist_id):
+        if not existing_ids(Movies, [movie_id]) \
+                or not existing_ids(Artists, [artist_id]):
+            abort(404)
+        performance = Performances.query.filter_by(
+            movie_id=movie_id, artist_id=artist_id).one_or_none()
+        if performance is None:
+            try:
+                performance = Performances(movie_id=movie_id,
+                                           artist_id=artist_id)
+                performance.insert()
             except Exception:
                 abort(422)
-            return jsonify({
-                'success': True,
-                'updated_artist': artist.format()
-                })
+        return jsonify({
+            'success': True,
+            'performance': performance.format()
+            })
 
-# PATCH movies/id
-    @app.route('/movies/<int:movie_id>', methods=['PATCH'])
+# DELETE movies/id/artists/id
+    @app.route('/movies/<int:movie_id>/artists/<int:artist_id>',
+               methods=['DELETE'])
     @requires_auth('patch:movie')
-    def update_movie(movie_id):
-        movie = Movies.query.get(movie_id)
-        if movie is None:
+    def unassign_artist(payload, movie_id, artist_id):
+        performance = Performances.query.filter_by(
+            movie_id=movie_id, artist_id=artist_id).one_or_none()
+        if performance is None:
             abort(404)
-        else:
-            try:
-                body = request.get_json()
+        try:
+            performance.delete()
+        except Exception:
+            abort(422)
+        return jsonify({
+            'success': True,
+            'deleted_performance_id': performance.id
+            })
 
-                title = body.get('title')
-                release_date = body.get('release_date')
+# GET changes
+    @app.route('/changes', methods=['GET'])
+    @requires_auth('get:artists', 'get:movies')
+    @read_only
+    def get_changes(payload):
+        try:
+            since = int(request.args.get('since', 0))
+            limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+        except ValueError:
+            abort(400)
+        if since < 0 or limit < 1:
+            abort(400)
+        if wants_stream():
+            return ndjson_response(iter_changes(since))
 
-                movie.title = title
-                movie.release_date = release_date
+        changes = list(iter_changes(since, min(limit, MAX_PAGE_SIZE)))
+        return jsonify({
+            'success': True,
+            'changes': changes,
+            'next_cursor': changes[-1]['cursor'] if changes else since
+            })
 
-                movie.update()
-            except Exception:
-                abort(422)
-            return jsonify({
-                'success': True,
-                'updated_movie': movie.format()
-                })
+# GET events
+    @app.route('/events', methods=['GET'])
+    @requires_auth('get:artists', 'get:movies')
+    def get_events(payload):
+        subscription = events.broker.subscribe()
+        if subscription is None:
+            abort(503)
+        return Response(events.event_stream(events.broker, subscription),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+
+# GET metrics
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        metrics = pool_metrics(engines(app)) + [request_latency.metric()]
+        return Response(render(metrics), mimetype=CONTENT_TYPE)
+
+# 400 error
+    @app.errorhandler(400)
+    def bad_request(error):
+        return jsonify({
+            'success': False,
+            'error': 400,
+            'message': 'bad request'
+            }), 400
 
 # 404 error
     @app.errorhandler(404)
@@ -225,6 +730,24 @@ def create_app(test_config=None):
             'message': 'method not allowed'
             }), 405
 
+# 412 error
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            'success': False,
+            'error': 412,
+            'message': 'precondition failed'
+            }), 412
+
+# 413 error
+    @app.errorhandler(413)
+    def payload_too_large(error):
+        return jsonify({
+            'success': False,
+            'error': 413,
+            'message': 'payload too large'
+            }), 413
+
 # 422 error
     @app.errorhandler(422)
     def unprocessable_request(error):
@@ -234,6 +757,15 @@ def create_app(test_config=None):
             'message': 'unprocessable'
             }), 422
 
+# 503 error
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return jsonify({
+            'success': False,
+            'error': 503,
+            'message': 'service unavailable'
+            }), 503
+
 # Authentication Error
     @app.errorhandler(AuthError)
     def unauthorized(ex):
@@ -243,10 +775,34 @@ def create_app(test_config=None):
             "message": ex.error
             }), 401
 
+# Rate limit and admission errors
+    @app.errorhandler(LimitExceeded)
+    def limit_exceeded(ex):
+        return jsonify({
+            'success': False,
+            'error': ex.status_code,
+            'message': ex.error
+            }), ex.status_code, {'Retry-After': str(ex.retry_after)}
+
     return app
 
 
-app = create_app()
+_app_lock = threading.Lock()
+
+
+def __getattr__(name):
+    '''
+    Creates the module's `app`, used by gunicorn api:app and flask run,
+    on first access, so importing create_app doesn't build an app.
+    '''
+    if name != 'app':
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    global app
+    with _app_lock:
+        if 'app' not in globals():
+            app = create_app()
+    return app
+
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080, debug=True)
+    create_app().run(host='0.0.0.0', port=8080, debug=True)
@@ -0,0 +1,303 @@
+'''
+Async serving mode of the Casting Agency API.
+
+Run with `uvicorn asgi:app`. The read routes, GET /artists, /movies and
+the single artist and movie, run on the event loop with an async
+database driver. Every other route is served by the Flask app from
+api.create_app through a WSGI bridge, so both modes expose the same API.
+'''
+import asyncio
+from functools import partial, wraps
+from urllib.parse import urlencode
+
+from databases import Database
+from sqlalchemy import select
+from starlette.applications import Starlette
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_accept_header, parse_etags
+
+import api
+from auth import (ALL, AuthError, check_permissions, compile_permissions,
+                  parse_auth_header, rate_limit_subject, token_cache,
+                  verify_token)
+from ratelimit import LimitExceeded, async_admission, rate_limiter
+from cache import response_cache
+from compress import decoded_etag, encode, encoded_etag
+from fastjson import dumps
+from models import (Artists, Movies, generation_select, live,
+                    page_from_rows, page_select, rows_select, db_url,
+                    replica_url, DB_POOL_SIZE, DB_MAX_OVERFLOW,
+                    STREAM_BATCH_SIZE)
+
+HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+    'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS'
+}
+
+MESSAGES = {
+    400: 'bad request',
+    404: 'resource not found',
+    405: 'method not allowed',
+    412: 'precondition failed',
+    413: 'payload too large',
+    422: 'unprocessable',
+    503: 'service unavailable'
+}
+
+
+def create_database(url):
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    if url.startswith('postgresql'):
+        return Database(url, min_size=1,
+                        max_size=DB_POOL_SIZE + DB_MAX_OVERFLOW)
+    return Database(url)
+
+
+async def off_loop(backend, function, *args):
+    '''
+    Calls `function`, in a worker thread when `backend` is a shared one
+    whose network round trips would block the event loop.
+    '''
+    if not backend.shared:
+        return function(*args)
+    return await asyncio.get_running_loop().run_in_executor(
+        None, partial(function, *args))
+
+
+def cached(function, *args):
+    return off_loop(response_cache.backend, function, *args)
+
+
+def requires_auth(*permissions, match=ALL):
+    '''
+    Async counterpart of auth.requires_auth. Cached tokens are checked
+    on the event loop, a cache miss is verified in a worker thread.
+    Rate limits are shared with the Flask routes. Admission control
+    waits for a slot without blocking the loop.
+    '''
+    required = compile_permissions(permissions, match)
+
+    def requires_auth_decorator(f):
+        @wraps(f)
+        async def wrapper(request):
+            token = parse_auth_header(request.headers.get('Authorization'))
+            entry = token_cache.get(token)
+            if entry is None:
+                entry = await asyncio.get_running_loop().run_in_executor(
+                    None, verify_token, token)
+            payload, granted = entry
+            check_permissions(required, granted, match)
+            await off_loop(rate_limiter.backend, rate_limiter.check,
+                           rate_limit_subject(payload, token), required)
+            async with async_admission:
+                return await f(request, payload)
+
+        return wrapper
+    return requires_auth_decorator
+
+
+def matched_etag(request, etag):
+    tags = parse_etags(request.headers.get('If-None-Match'))
+    if tags.star_tag:
+        return etag
+    return next((tag for tag in tags.as_set(include_weak=True)
+                 if decoded_etag(tag) == etag), None)
+
+
+async def cached_response(request, key, table, build, generation,
+                          etag=None):
+    entry = await cached(response_cache.get, key)
+    if entry is None:
+        data = await build()
+        body = dumps(data, sort_keys=True)
+        entry = await cached(response_cache.set, key, body, table,
+                             generation, etag and etag(data))
+    body, etag = entry
+    sent = matched_etag(request, etag)
+    if sent is not None:
+        return not_modified(sent)
+    data, encoding = encode(body.encode(),
+                            request.headers.get('Accept-Encoding'))
+    headers = dict(HEADERS, ETag=f'"{etag}"', Vary='Accept-Encoding')
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+        headers['ETag'] = f'"{encoded_etag(etag, encoding)}"'
+    return Response(data, media_type='application/json', headers=headers)
+
+
+def not_modified(etag):
+    return Response(status_code=304, headers=dict(
+        HEADERS, ETag=f'"{etag}"', Vary='Accept-Encoding'))
+
+
+def wants_stream(request):
+    return api.wants_stream(request.query_params, parse_accept_header(
+        request.headers.get('Accept'), MIMEAccept))
+
+
+def create_asgi_app(flask_app=None, database_url=None,
+                    replica_url=replica_url):
+    '''
+    Builds the ASGI app. Reads go to the replica when one is configured,
+    except cache misses of a table written in the last DB_REPLICA_LAG
+    seconds, which read the primary as the Flask routes do.
+    '''
+    flask_app = flask_app or api.app
+    primary = create_database(database_url or db_url)
+    database = create_database(replica_url) if replica_url else primary
+
+    async def generation(table):
+        if response_cache.database_generations:
+            return await primary.fetch_val(generation_select(table)) or 0
+        return await cached(response_cache.generation, table)
+
+    async def fresh_database(table):
+        if database is not primary \
+                and await cached(response_cache.recently_written, table):
+            return primary
+        return database
+
+    async def connect():
+        for connected in {primary, database}:
+            await connected.connect()
+
+    async def disconnect():
+        for connected in {primary, database}:
+            await connected.disconnect()
+
+    async def ndjson_rows(model, after, fields, filters, sort):
+        fields = fields or model.FIELDS
+        query = rows_select(model, after, fields, filters, sort)
+        reader = await fresh_database(model.__tablename__)
+        lines = []
+        async for row in reader.iterate(query):
+            lines.append(dumps({field: row[field] for field in fields}))
+            if len(lines) >= STREAM_BATCH_SIZE:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    async def list_response(request, model, name):
+        after, limit, fields, filters, sort = api.get_page_args(
+            model, request.query_params)
+        if wants_stream(request):
+            return StreamingResponse(
+                ndjson_rows(model, after, fields, filters, sort),
+                media_type=api.NDJSON, headers=HEADERS)
+
+        async def build():
+            reader = await fresh_database(model.__tablename__)
+            rows = await reader.fetch_all(
+                page_select(model, after, limit, fields, filters, sort))
+            items, next_cursor = page_from_rows(model, rows, limit, fields,
+                                                sort)
+            return {
+                'success': True,
+                name: items,
+                'next_cursor': next_cursor
+            }
+        table = model.__tablename__
+        args = urlencode(sorted(request.query_params.multi_items()))
+        page_generation = await generation(table)
+        tag = await cached(response_cache.list_etag, table, args,
+                           page_generation)
+        sent = tag and matched_etag(request, tag)
+        if sent is not None:
+            return not_modified(sent)
+        key = response_cache.list_key(table, args, page_generation)
+        return await cached_response(request, key, table, build,
+                                     page_generation,
+                                     etag=tag and (lambda data: tag))
+
+    async def entity_response(request, model, name, id):
+        table = model.__table__
+
+        async def build():
+            reader = await fresh_database(model.__tablename__)
+            row = await reader.fetch_one(
+                select([table]).where(table.c.id == id)
+                .where(live(model)))
+            if row is None:
+                api.abort(404)
+            return {
+                'success': True,
+                name: {field: row[field]
+                       for field in model.FIELDS + ('version',)}
+            }
+        entity_generation = await generation(model.__tablename__)
+        key = response_cache.entity_key(model.__tablename__, id,
+                                        entity_generation)
+        return await cached_response(
+            request, key, model.__tablename__, build, entity_generation,
+            etag=lambda data: api.version_tag(data[name]['version']))
+
+# GET /artists
+    @requires_auth('get:artists')
+    async def get_all_actors(request, payload):
+        return await list_response(request, Artists, 'artists')
+
+# GET /artists/<int:artist_id>
+    @requires_auth('get:artist')
+    async def get_actor(request, payload):
+        return await entity_response(request, Artists, 'artist',
+                                     request.path_params['artist_id'])
+
+# GET movies
+    @requires_auth('get:movies')
+    async def get_all_movies(request, payload):
+        return await list_response(request, Movies, 'movies')
+
+# GET movies/id
+    @requires_auth('get:movie')
+    async def get_movie(request, payload):
+        return await entity_response(request, Movies, 'movie',
+                                     request.path_params['movie_id'])
+
+    async def http_error(request, error):
+        return JSONResponse({
+            'success': False,
+            'error': error.code,
+            'message': MESSAGES.get(error.code, error.name.lower())
+            }, status_code=error.code, headers=HEADERS)
+
+    async def limit_exceeded(request, ex):
+        return JSONResponse({
+            'success': False,
+            'error': ex.status_code,
+            'message': ex.error
+            }, status_code=ex.status_code,
+            headers=dict(HEADERS, **{'Retry-After': str(ex.retry_after)}))
+
+    async def unauthorized(request, ex):
+        return JSONResponse({
+            'success': False,
+            'error': ex.status_code,
+            'message': ex.error
+            }, status_code=401, headers=HEADERS)
+
+    return Starlette(
+        routes=[
+            Route('/artists', get_all_actors, methods=['GET']),
+            Route('/artists/{artist_id:int}', get_actor, methods=['GET']),
+            Route('/movies', get_all_movies, methods=['GET']),
+            Route('/movies/{movie_id:int}', get_movie, methods=['GET']),
+            Mount('', app=WSGIMiddleware(flask_app))
+        ],
+        exception_handlers={
+            HTTPException: http_error,
+            AuthError: unauthorized,
+            LimitExceeded: limit_exceeded
+        },
+        on_startup=[connect],
+        on_shutdown=[disconnect]
+    )
+
+
+app = create_asgi_app()
@@ -1,13 +1,45 @@
+import hashlib
 import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
 from flask import request, _request_ctx_stack, abort
 from functools import wraps
-from jose import jwt
+from jose import jwk, jwt
 from urllib.request import urlopen
+from metrics import phase
+from ratelimit import admission, rate_limiter
 
 
-AUTH0_DOMAIN = 'coffe-shop-fsnd.eu.auth0.com'
+AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN', 'coffe-shop-fsnd.eu.auth0.com')
 ALGORITHMS = ['RS256']
-API_AUDIENCE = 'coffee_shop'
+API_AUDIENCE = os.environ.get('API_AUDIENCE', 'coffee_shop')
+JWT_ISSUER = os.environ.get('JWT_ISSUER', f'https://{AUTH0_DOMAIN}/')
+
+# permission matching modes of requires_auth
+ALL = 'all'
+ANY = 'any'
+
+JWKS_URL = os.environ.get('JWKS_URL',
+                          f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_FILE = os.environ.get('JWKS_FILE')
+PEM_KEYS_DIR = os.environ.get('PEM_KEYS_DIR')
+# jwks, file or pem, by default file when JWKS_FILE is set
+KEY_PROVIDER = os.environ.get('KEY_PROVIDER',
+                              'file' if JWKS_FILE else 'jwks')
+JWKS_TTL = float(os.environ.get('JWKS_TTL', 3600))
+JWKS_REFRESH_AHEAD = float(os.environ.get('JWKS_REFRESH_AHEAD', 300))
+JWKS_MIN_REFETCH_INTERVAL = float(
+    os.environ.get('JWKS_MIN_REFETCH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+
+TOKEN_CACHE_ENABLED = os.environ.get('TOKEN_CACHE_ENABLED', '1') != '0'
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+TOKEN_CACHE_TTL = float(os.environ.get('TOKEN_CACHE_TTL', 300))
+
+logger = logging.getLogger(__name__)
 
 # AuthError Exception
 '''
@@ -22,10 +54,284 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# Key providers
+#
+# A provider returns the verification key of a kid, parsed once when it
+# is loaded, or None for an unknown kid.
+
+def parse_jwk(key):
+    return jwk.construct(key, key.get('alg', ALGORITHMS[0]))
+
+
+def parse_pem(pem):
+    key = jwk.construct(pem, ALGORITHMS[0])
+    return key if key.is_public() else key.public_key()
+
+
+def parse_jwks(jwks, parse=parse_jwk):
+    '''
+    The keys of a JWKS document by kid. Keys that can't be parsed are
+    skipped.
+    '''
+    keys = {}
+    for key in jwks['keys']:
+        if 'kid' not in key:
+            continue
+        try:
+            keys[key['kid']] = parse(key)
+        except Exception:
+            logger.warning('skipping JWKS key %s', key['kid'],
+                           exc_info=True)
+    return keys
+
+
+def fetch_remote_jwks(url=JWKS_URL, timeout=JWKS_FETCH_TIMEOUT):
+    with urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def jwks_file_fetcher(path):
+    '''
+    Fetcher reading a JWKS document from a local file,
+    used for tests and offline environments.
+    '''
+    def fetch():
+        with open(path) as jwks_file:
+            return json.load(jwks_file)
+    return fetch
+
+
+class JWKSCache:
+    '''
+    Process-wide cache of the JWKS signing keys, keyed by kid.
+
+    Keys are fetched once and reused for `ttl` seconds. Within
+    `refresh_ahead` seconds of expiry, and past it, a background refresh
+    is started, so requests only wait on the network for the very first
+    fetch. An unknown kid triggers one synchronous refetch, and every
+    fetch is rate limited by `min_refetch_interval`. When a refresh
+    fails the last known keys keep being served, expired or not, while
+    one background refresh retries. Keys are stored as `parse` returns
+    them, JWK dicts unless it is given.
+    '''
+
+    def __init__(self, fetcher,
+                 ttl=JWKS_TTL,
+                 refresh_ahead=JWKS_REFRESH_AHEAD,
+                 min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL,
+                 clock=time.monotonic,
+                 parse=None):
+        self.fetcher = fetcher
+        self.parse = parse
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.min_refetch_interval = min_refetch_interval
+        self.clock = clock
+        self.keys = {}
+        self.fetched_at = None
+        self.last_attempt = None
+        self.refresh_thread = None
+        self._fetch_lock = threading.Lock()
+        self._thread_lock = threading.Lock()
+
+    def throttled(self, now):
+        return self.last_attempt is not None \
+            and now - self.last_attempt < self.min_refetch_interval
+
+    def refresh(self, force=False):
+        with self._fetch_lock:
+            now = self.clock()
+            if not force and self.throttled(now):
+                return False
+            self.last_attempt = now
+            try:
+                jwks = self.fetcher()
+                if self.parse is None:
+                    keys = {key['kid']: key for key in jwks['keys']
+                            if 'kid' in key}
+                else:
+                    keys = parse_jwks(jwks, self.parse)
+            except Exception:
+                logger.warning('JWKS refresh failed, keeping %d cached keys',
+                               len(self.keys), exc_info=True)
+                return False
+            self.keys = keys
+            self.fetched_at = self.clock()
+            return True
+
+    def refresh_in_background(self):
+        with self._thread_lock:
+            if self.throttled(self.clock()) or (
+                    self.refresh_thread is not None
+                    and self.refresh_thread.is_alive()):
+                return self.refresh_thread
+            self.refresh_thread = threading.Thread(
+                target=self.refresh, name='jwks-refresh', daemon=True)
+            self.refresh_thread.start()
+            return self.refresh_thread
+
+    def get_key(self, kid):
+        if self.fetched_at is None:
+            with phase('jwks'):
+                self.refresh()
+        elif self.clock() - self.fetched_at >= self.ttl - self.refresh_ahead:
+            # expired keys are served too, a failing fetch never stalls
+            # the requests behind it
+            self.refresh_in_background()
+
+        key = self.keys.get(kid)
+        if key is None:
+            with phase('jwks'):
+                if self.refresh():
+                    key = self.keys.get(kid)
+        return key
+
+
+class StaticKeys:
+    '''
+    Keys loaded once, from a JWKS file or a directory of PEM public
+    keys. Verification never leaves the process.
+    '''
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    @classmethod
+    def from_jwks_file(cls, path):
+        return cls(parse_jwks(jwks_file_fetcher(path)()))
+
+    @classmethod
+    def from_pem_directory(cls, directory):
+        '''
+        One key per <kid>.pem file. Of a private key only the public
+        half is kept.
+        '''
+        keys = {}
+        for name in sorted(os.listdir(directory)):
+            kid, extension = os.path.splitext(name)
+            if extension != '.pem':
+                continue
+            with open(os.path.join(directory, name)) as pem_file:
+                keys[kid] = parse_pem(pem_file.read())
+        return cls(keys)
+
+    def get_key(self, kid):
+        return self.keys.get(kid)
+
+
+def create_key_provider(name=KEY_PROVIDER, jwks_file=JWKS_FILE,
+                        pem_keys_dir=PEM_KEYS_DIR):
+    if name == 'jwks':
+        return JWKSCache(fetch_remote_jwks, parse=parse_jwk)
+    if name == 'file':
+        if not jwks_file:
+            raise ValueError('the file key provider needs JWKS_FILE')
+        return StaticKeys.from_jwks_file(jwks_file)
+    if name == 'pem':
+        # without a directory os.listdir would read the working directory
+        if not pem_keys_dir:
+            raise ValueError('the pem key provider needs PEM_KEYS_DIR')
+        return StaticKeys.from_pem_directory(pem_keys_dir)
+    raise ValueError(f'unknown key provider: {name}')
+
+
+key_provider = create_key_provider()
+
+
+# Verified token cache
+
+class TokenCache:
+    '''
+    Bounded LRU cache of verified token payloads and their permission
+    sets, keyed by the SHA-256 digest of the raw token. An entry lives at
+    most `ttl` seconds and never past the token's own `exp` claim.
+    '''
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL,
+                 enabled=TOKEN_CACHE_ENABLED, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.enabled = enabled
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        if not self.enabled:
+            return None
+        key = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] <= self.clock():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, token, payload, permissions=frozenset()):
+        if not self.enabled or self.maxsize <= 0:
+            return
+        now = self.clock()
+        expires_at = now + self.ttl
+        if 'exp' in payload:
+            expires_at = min(expires_at, payload['exp'])
+        if expires_at <= now:
+            return
+        key = self.digest(token)
+        with self._lock:
+            self._entries[key] = (payload, permissions, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'maxsize': self.maxsize
+        }
+
+
+token_cache = TokenCache()
+
+
 # Auth Header
 
+def rate_limit_subject(payload, token):
+    '''
+    The subject whose buckets a request draws from: the `sub` of its
+    token, or a hash of the token for tokens without one, so they don't
+    all share a single bucket.
+    '''
+    subject = payload.get('sub')
+    if subject:
+        return subject
+    return 'token:' + hashlib.sha256(token.encode()).hexdigest()[:32]
+
+
 def get_token_auth_header():
-    header = request.headers.get('Authorization', None)
+    return parse_auth_header(request.headers.get('Authorization', None))
+
+
+def parse_auth_header(header):
     if not header:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -56,14 +362,23 @@ def get_token_auth_header():
     return JWT
 
 
-def check_permissions(permission, payload):
-    if 'permission' not in payload:
+def get_permissions(payload):
+    if 'permissions' not in payload:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permission not found in JWT'
         }, 400)
 
-    if permission not in payload['permission']:
+    return frozenset(payload['permissions'])
+
+
+def check_permissions(required, granted, match=ALL):
+    if match == ALL:
+        allowed = required <= granted
+    else:
+        allowed = not required or not required.isdisjoint(granted)
+
+    if not allowed:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found'
@@ -73,8 +388,6 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    url = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks_json = json.loads(url.read())
     header = jwt.get_unverified_header(token)
 
     if 'kid' not in header:
@@ -83,17 +396,7 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    key = {}
-    for key in jwks_json['keys']:
-        if key['kid'] == header['kid']:
-            key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-
+    key = key_provider.get_key(header['kid'])
     if key:
         try:
             payload = jwt.decode(
@@ -101,7 +404,7 @@ def verify_decode_jwt(token):
                 key,
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                issuer=JWT_ISSUER
             )
 
             return payload
@@ -131,21 +434,51 @@ def verify_decode_jwt(token):
     }, 400)
 
 
-def requires_auth(permission=''):
+def verify_token(token):
+    '''
+    Verifies a token that missed the token cache and caches it.
+    Returns the payload and its permission set.
+    '''
+    try:
+        payload = verify_decode_jwt(token)
+    except Exception:
+        raise AuthError({
+            'code': 'invalid_token',
+            'description': 'Access denied due to invalid token'
+        }, 401)
+    granted = get_permissions(payload)
+    token_cache.put(token, payload, granted)
+    return payload, granted
+
+
+def compile_permissions(permissions, match=ALL):
+    if match not in (ALL, ANY):
+        raise ValueError(f'unknown permission match mode: {match}')
+    return frozenset(permission for permission in permissions
+                     if permission)
+
+
+def requires_auth(*permissions, match=ALL):
+    '''
+    Require a valid bearer token carrying the given permissions.
+    With match=ALL every permission is needed, with match=ANY one of
+    them is enough. The subject of the token is then rate limited per
+    required permission, and the view runs in an admission slot.
+    '''
+    required = compile_permissions(permissions, match)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-            except Exception:
-                raise AuthError({
-                    'code': 'invalid_token',
-                    'description': 'Access denied due to invalid token'
-                }, 401)
-
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            with phase('auth'):
+                token = get_token_auth_header()
+                payload, granted = token_cache.get(token) \
+                    or verify_token(token)
+                check_permissions(required, granted, match)
+                rate_limiter.check(rate_limit_subject(payload, token),
+                                   required)
+            with admission:
+                return f(payload, *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
@@ -0,0 +1,596 @@
+'''
+Benchmark of every route of api.create_app against a seeded database.
+
+    python bench.py run --rows 100000 --concurrency 8 --output head.json
+    python bench.py compare base.json head.json --threshold 10
+    python bench.py serialize --rows 100000
+
+`run` drops and reseeds the tables of --database-url (a throwaway
+SQLite file by default), mints a token from a local signing key and
+sends --requests requests to each route from --concurrency threads
+through the Flask test client. Reads run before writes, and writes
+only delete spare rows seeded for them, so the read routes always see
+--rows artists and movies. The report holds requests per second,
+p50/p95/p99 latency and SQL statements per request of each route.
+
+`compare` prints the change of each route between two reports and
+exits with status 1 when one regressed by more than --threshold percent
+or runs more queries per request.
+
+`serialize` times building and encoding one list response of --rows
+artists from ORM instances and from column tuples.
+
+`startup` times, in fresh interpreters, importing api, building the app
+with create_app, as the first time and as every further test does, and
+the first request. It also times a worker forked from a process that
+preloaded the app, as gunicorn does with preload_app, up to its first
+response.
+'''
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event, select
+
+from loadtest import summarize
+from localauth import LocalKey, PRODUCER
+
+GENDERS = ('female', 'male')
+METHOD_ORDER = ('GET', 'POST', 'PATCH', 'DELETE')
+BATCH_SIZE = 10
+# the event stream never ends, it can't be timed per request
+SKIPPED_ENDPOINTS = ('static', 'get_events')
+SEED_CHUNK_SIZE = 10000
+
+
+def default_database_url():
+    return 'sqlite:///' + os.path.join(tempfile.gettempdir(),
+                                       'casting_bench.db')
+
+
+# Seeding
+
+def artist_row(n):
+    return {'name': f'Artist {n}', 'age': 18 + n % 60,
+            'gender': GENDERS[n % 2]}
+
+
+def movie_row(n):
+    return {'title': f'Movie {n}', 'release_date': 1950 + n % 75}
+
+
+def cast_artist(movie_id, index, rows, cast):
+    return (movie_id * cast + index) % rows + 1
+
+
+def batches(values, size=SEED_CHUNK_SIZE):
+    values = iter(values)
+    while True:
+        batch = list(itertools.islice(values, size))
+        if not batch:
+            return
+        yield batch
+
+
+def seed(db, models, rows, spare, cast):
+    '''
+    Recreates the tables with rows + spare artists and movies, ids
+    counting up from 1, and `cast` artists in each of the first `rows`
+    movies.
+    '''
+    db.drop_all()
+    db.create_all()
+    total = rows + spare
+    tables = (
+        (models.Artists.__table__, (artist_row(n)
+                                    for n in range(1, total + 1))),
+        (models.Movies.__table__, (movie_row(n)
+                                   for n in range(1, total + 1))),
+        (models.Performances.__table__, (
+            {'movie_id': movie_id,
+             'artist_id': cast_artist(movie_id, index, rows, cast)}
+            for movie_id in range(1, rows + 1)
+            for index in range(cast)))
+    )
+    for table, values in tables:
+        for batch in batches(values):
+            db.session.execute(table.insert(), batch)
+        db.session.commit()
+    models.rebuild_counts()
+
+
+# Requests
+
+class Fixtures:
+    '''
+    Ids the generated requests refer to. Reads and updates pick any of
+    the seeded rows, deletes take spare rows, each one once.
+    '''
+
+    def __init__(self, rows, cast):
+        self.rows = rows
+        self.cast = cast
+        self._spare = {'artist_id': itertools.count(rows + 1),
+                       'movie_id': itertools.count(rows + 1)}
+        self._cast = itertools.count()
+        self._serial = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def any_id(self):
+        return random.randint(1, self.rows)
+
+    def spare_id(self, name):
+        with self._lock:
+            return next(self._spare[name])
+
+    def spare_ids(self, name, count):
+        with self._lock:
+            return [next(self._spare[name]) for _ in range(count)]
+
+    def performance(self):
+        '''
+        A seeded (movie_id, artist_id) pair that was not returned before.
+        '''
+        with self._lock:
+            index = next(self._cast)
+        movie_id = index // self.cast + 1
+        return movie_id, cast_artist(movie_id, index % self.cast,
+                                     self.rows, self.cast)
+
+    def serial(self):
+        with self._lock:
+            return next(self._serial)
+
+
+def artist_body(fixtures):
+    n = fixtures.serial()
+    return dict(artist_row(n), name=f'Bench Artist {n}')
+
+
+def movie_body(fixtures):
+    n = fixtures.serial()
+    return dict(movie_row(n), title=f'Bench Movie {n}')
+
+
+def url_for(rule, values):
+    path = rule.rule
+    for name in rule.arguments:
+        path = path.replace(f'<int:{name}>', str(values[name])) \
+            .replace(f'<{name}>', str(values[name]))
+    return path
+
+
+def request_factory(rule, method, fixtures):
+    '''
+    Returns a function building the (path, json body) of one request to
+    the route. Routes without a dedicated body get random seeded ids
+    for their arguments.
+    '''
+    if method == 'DELETE' and rule.arguments == {'movie_id', 'artist_id'}:
+        def performance():
+            movie_id, artist_id = fixtures.performance()
+            return url_for(rule, {'movie_id': movie_id,
+                                  'artist_id': artist_id}), None
+        return performance
+
+    if rule.rule.endswith(':batch'):
+        name = 'artist_id' if rule.rule.startswith('/artists') \
+            else 'movie_id'
+        body = artist_body if name == 'artist_id' else movie_body
+
+        def batch():
+            if method == 'POST':
+                items = [body(fixtures) for _ in range(BATCH_SIZE)]
+            elif method == 'PATCH':
+                items = [dict(body(fixtures), id=fixtures.any_id())
+                         for _ in range(BATCH_SIZE)]
+            else:
+                items = fixtures.spare_ids(name, BATCH_SIZE)
+            return rule.rule, items
+        return batch
+
+    bodies = {'/artists': artist_body, '/artists/<int:artist_id>':
+              artist_body, '/movies': movie_body,
+              '/movies/<int:movie_id>': movie_body}
+
+    def single():
+        if method == 'DELETE':
+            values = {name: fixtures.spare_id(name)
+                      for name in rule.arguments}
+        else:
+            values = {name: fixtures.any_id() for name in rule.arguments}
+        make_body = bodies.get(rule.rule) \
+            if method in ('POST', 'PATCH') else None
+        return url_for(rule, values), make_body and make_body(fixtures)
+    return single
+
+
+def routes(app):
+    '''
+    (method, rule) of every route, reads first and deletes last.
+    '''
+    found = [(method, rule) for rule in app.url_map.iter_rules()
+             if rule.endpoint not in SKIPPED_ENDPOINTS
+             for method in rule.methods if method in METHOD_ORDER]
+    return sorted(found, key=lambda route: (
+        METHOD_ORDER.index(route[0]), route[1].rule))
+
+
+# Measurement
+
+class QueryCounter(threading.local):
+    count = 0
+
+
+def count_queries(engines):
+    counter = QueryCounter()
+
+    def before_cursor_execute(*args):
+        counter.count += 1
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    return counter
+
+
+def drive(app, method, make_request, headers, requests, concurrency,
+          counter):
+    '''
+    Sends `requests` requests from `concurrency` threads, one test
+    client each, and summarizes them.
+    '''
+    latencies = []
+    queries = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def worker(count):
+        client = app.test_client()
+        local_latencies = []
+        local_queries = []
+        local_statuses = {}
+        for _ in range(count):
+            path, body = make_request()
+            counter.count = 0
+            start = time.perf_counter()
+            response = client.open(path, method=method, json=body,
+                                   headers=headers)
+            response.get_data()
+            local_latencies.append(time.perf_counter() - start)
+            local_queries.append(counter.count)
+            status = str(response.status_code)
+            local_statuses[status] = local_statuses.get(status, 0) + 1
+        with lock:
+            latencies.extend(local_latencies)
+            queries.extend(local_queries)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    counts = [requests // concurrency + (index < requests % concurrency)
+              for index in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(worker, [count for count in counts if count]))
+    elapsed = time.perf_counter() - start
+    errors = sum(count for status, count in statuses.items()
+                 if int(status) >= 400)
+    result = summarize(latencies, errors, elapsed)
+    result['queries_per_request'] = \
+        round(sum(queries) / len(queries), 2) if queries else 0
+    result['statuses'] = statuses
+    return result
+
+
+def load_app(database_url, keys):
+    # the app reads its configuration when it is first imported
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['JWKS_FILE'] = LocalKey.jwks_path(keys)
+    # one subject sends every request, limits would only measure 429s
+    os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+    import api
+    import models
+    return api.app, models
+
+
+def run(args):
+    key = LocalKey.load(args.keys)
+    app, models = load_app(args.database_url, args.keys)
+    from cache import response_cache
+
+    response_cache.enabled = not args.no_cache
+    selected = [(method, rule) for method, rule in routes(app)
+                if not args.route
+                or any(name in f'{method} {rule.rule}'
+                       for name in args.route)]
+    spare = args.requests * (BATCH_SIZE + 1)
+    if args.requests > args.rows * args.cast:
+        sys.exit('--requests must not exceed --rows times --cast')
+
+    with app.app_context():
+        started = time.perf_counter()
+        seed(models.db, models, args.rows, spare, args.cast)
+        seed_seconds = time.perf_counter() - started
+        engines = models.engines(app)
+        dialect = engines['default'].dialect.name
+        counter = count_queries(engines.values())
+
+    headers = {'Authorization': f'Bearer {key.mint_token(PRODUCER)}'}
+    fixtures = Fixtures(args.rows, args.cast)
+    results = {}
+    for method, rule in selected:
+        name = f'{method} {rule.rule}'
+        result = drive(app, method, request_factory(rule, method, fixtures),
+                       headers, args.requests, args.concurrency, counter)
+        results[name] = result
+        print(f"{name:<56} {result['rps']:>9} rps  "
+              f"p50 {result['p50_ms']} ms  p99 {result['p99_ms']} ms  "
+              f"{result['queries_per_request']} queries  "
+              f"errors {result['errors']}")
+
+    report = {
+        'meta': {
+            'rows': args.rows,
+            'cast': args.cast,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'cache': not args.no_cache,
+            'database': dialect,
+            'seed_seconds': round(seed_seconds, 2),
+            'python': platform.python_version(),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        },
+        'routes': results
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    return report
+
+
+# Serialization
+
+def serialize(args):
+    '''
+    Times building and encoding a list response of --rows artists three
+    ways: ORM instances with format() and the json module, as list
+    responses were built before, column tuples with the json module, and
+    column tuples with orjson when it is installed.
+    '''
+    app, models = load_app(args.database_url, args.keys)
+    import fastjson
+    Artists = models.Artists
+    db = models.db
+
+    def orm_rows():
+        return [artist.format() for artist in Artists.query.all()]
+
+    def column_rows():
+        rows = db.session.execute(
+            select(models.columns(Artists))).fetchall()
+        return [dict(zip(Artists.FIELDS, row)) for row in rows]
+
+    def stdlib_dumps(data):
+        return json.dumps(data, separators=(',', ':'), sort_keys=True)
+
+    def fast_dumps(data):
+        return fastjson.dumps(data, sort_keys=True)
+
+    paths = [
+        ('orm+format, json', orm_rows, stdlib_dumps),
+        ('columns, json', column_rows, stdlib_dumps)
+    ]
+    if fastjson.orjson:
+        paths.append(('columns, orjson', column_rows, fast_dumps))
+    results = {}
+    with app.app_context():
+        seed(db, models, args.rows, 0, 0)
+        for name, build, encode in paths:
+            timings = []
+            for _ in range(args.repeat):
+                db.session.remove()
+                start = time.perf_counter()
+                data = {'success': True, 'artists': build()}
+                built = time.perf_counter()
+                encode(data)
+                timings.append((built - start, time.perf_counter() - built))
+            build_seconds, encode_seconds = min(
+                timings, key=lambda timing: sum(timing))
+            results[name] = {
+                'build_ms': round(build_seconds * 1000, 1),
+                'encode_ms': round(encode_seconds * 1000, 1),
+                'total_ms': round((build_seconds + encode_seconds) * 1000, 1)
+            }
+    baseline = results[paths[0][0]]['total_ms']
+    for name, result in results.items():
+        result['speedup'] = round(baseline / result['total_ms'], 2)
+        print(f"{name:<20} build {result['build_ms']:>8} ms  "
+              f"encode {result['encode_ms']:>8} ms  "
+              f"total {result['total_ms']:>8} ms  {result['speedup']}x")
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'rows': args.rows, 'results': results}, output,
+                      indent=2)
+    return results
+
+
+# Startup
+
+STARTUP_SCRIPT = '''
+import json, os, time
+start = time.perf_counter()
+import api
+imported = time.perf_counter()
+app = api.create_app()
+created = time.perf_counter()
+api.create_app()
+created_again = time.perf_counter()
+app.test_client().get('/metrics')
+served = time.perf_counter()
+read, write = os.pipe()
+forked = time.perf_counter()
+pid = os.fork()
+if pid == 0:
+    app.test_client().get('/metrics')
+    os.write(write, str(time.perf_counter() - forked).encode())
+    os._exit(0)
+os.waitpid(pid, 0)
+forked_boot = float(os.read(read, 64))
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'create_app_again_ms': (created_again - created) * 1000,
+    'first_request_ms': (served - created_again) * 1000,
+    'cold_boot_ms': (served - start - (created_again - created)) * 1000,
+    'forked_boot_ms': forked_boot * 1000
+}))
+'''
+
+
+def startup(args):
+    env = dict(os.environ, DATABASE_URL=args.database_url)
+    samples = []
+    for _ in range(args.repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT], env=env, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, universal_newlines=True).stdout
+        samples.append(json.loads(output.splitlines()[-1]))
+    results = {name: round(statistics.median(
+                   sample[name] for sample in samples), 1)
+               for name in samples[0]}
+    for name, value in results.items():
+        print(f'{name:<22} {value:>8} ms')
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'repeat': args.repeat, 'results': results}, output,
+                      indent=2)
+    return results
+
+
+# Comparison
+
+def change(base, head):
+    if not base:
+        return None
+    return round((head - base) / base * 100, 1)
+
+
+def compare_reports(base, head, threshold):
+    '''
+    Returns (route, metric, base, head, change %, regressed) rows for the
+    routes of both reports. Lower rps, higher p99 latency beyond
+    `threshold` percent and any extra query per request are regressions.
+    '''
+    rows = []
+    for name in sorted(set(base['routes']) & set(head['routes'])):
+        before = base['routes'][name]
+        after = head['routes'][name]
+        for metric, worse in (('rps', -1), ('p99_ms', 1),
+                              ('queries_per_request', 1)):
+            percent = change(before[metric], after[metric])
+            if metric == 'queries_per_request':
+                # cache hits make the mean fractional
+                regressed = round(after[metric]) > round(before[metric])
+            else:
+                regressed = percent is not None \
+                    and percent * worse > threshold
+            rows.append((name, metric, before[metric], after[metric],
+                         percent, regressed))
+    return rows
+
+
+def compare(args):
+    with open(args.base) as base_file, open(args.head) as head_file:
+        base, head = json.load(base_file), json.load(head_file)
+    for key in ('rows', 'concurrency', 'database'):
+        if base['meta'].get(key) != head['meta'].get(key):
+            print(f"warning: {key} differs, {base['meta'].get(key)} "
+                  f"vs {head['meta'].get(key)}")
+    for name in sorted(set(base['routes']) ^ set(head['routes'])):
+        side = 'base' if name in base['routes'] else 'head'
+        print(f'{name:<56} only in {side}')
+
+    rows = compare_reports(base, head, args.threshold)
+    for name, metric, before, after, percent, regressed in rows:
+        percent = '' if percent is None else f'{percent:+.1f}%'
+        flag = '  REGRESSION' if regressed else ''
+        print(f'{name:<56} {metric:<20} {before:>10} -> {after:<10} '
+              f'{percent:>8}{flag}')
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='benchmark every route')
+    run_parser.add_argument('--database-url', default=default_database_url(),
+                            help='database to drop and seed')
+    run_parser.add_argument('--rows', type=int, default=10000,
+                            help='artists and movies to seed')
+    run_parser.add_argument('--cast', type=int, default=5,
+                            help='artists seeded in each movie')
+    run_parser.add_argument('--requests', type=int, default=200,
+                            help='requests sent to each route')
+    run_parser.add_argument('--concurrency', type=int, default=8)
+    run_parser.add_argument('--route', action='append',
+                            help='only routes containing this text, '
+                                 'e.g. "GET /artists"')
+    run_parser.add_argument('--no-cache', action='store_true',
+                            help='disable the response cache')
+    run_parser.add_argument('--keys', default='.keys',
+                            help='directory of the local signing key')
+    run_parser.add_argument('--output', help='write the report as JSON')
+
+    compare_parser = commands.add_parser(
+        'compare', help='compare two reports')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('head')
+    compare_parser.add_argument('--threshold', type=float, default=10,
+                                help='tolerated change in percent')
+
+    serialize_parser = commands.add_parser(
+        'serialize', help='time building and encoding a list response')
+    serialize_parser.add_argument('--database-url',
+                                  default=default_database_url(),
+                                  help='database to drop and seed')
+    serialize_parser.add_argument('--rows', type=int, default=100000)
+    serialize_parser.add_argument('--repeat', type=int, default=3)
+    serialize_parser.add_argument('--keys', default='.keys',
+                                  help='directory of the local signing key')
+    serialize_parser.add_argument('--output',
+                                  help='write the timings as JSON')
+
+    startup_parser = commands.add_parser(
+        'startup', help='time importing and building the app')
+    startup_parser.add_argument('--database-url',
+                                default=default_database_url(),
+                                help='database the app is configured with')
+    startup_parser.add_argument('--repeat', type=int, default=5,
+                                help='fresh interpreters to take the '
+                                     'median of')
+    startup_parser.add_argument('--output',
+                                help='write the timings as JSON')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'serialize':
+        serialize(args)
+    elif args.command == 'startup':
+        startup(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == '__main__':
+    main()
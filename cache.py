@@ -0,0 +1,235 @@
+import hashlib
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+
+CACHE_ENABLED = os.environ.get('CACHE_ENABLED', '1') != '0'
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+CACHE_SIZE = int(os.environ.get('CACHE_SIZE', 10000))
+CACHE_TTL = int(os.environ.get('CACHE_TTL', 300))
+
+
+# Backends
+
+class LRUBackend:
+    '''
+    In-process backend, one per worker. Entries are evicted least
+    recently used first, generation counters are never evicted.
+    '''
+    # counters only count the writes of this worker
+    shared = False
+
+    def __init__(self, maxsize=CACHE_SIZE, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = self.clock() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+
+class RedisBackend:
+    '''
+    Backend shared by all workers, on top of a redis-py compatible
+    client. Anything with get, set(ex=), delete and incr can stand in.
+    '''
+    # counters count the writes of every worker
+    shared = True
+
+    def __init__(self, client, prefix='casting:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if isinstance(value, bytes):
+            value = value.decode()
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, ex=ttl or None)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+    def counter(self, key):
+        return int(self.client.get(self.prefix + key) or 0)
+
+    def epoch(self):
+        '''
+        Nonce shared by all workers, replaced when redis loses its data
+        and the counters start over.
+        '''
+        key = self.prefix + 'epoch'
+        value = self.client.get(key)
+        if value is None:
+            self.client.set(key, secrets.token_hex(4), nx=True)
+            value = self.client.get(key)
+        return value.decode() if isinstance(value, bytes) else value
+
+
+def create_backend(name=CACHE_BACKEND):
+    if name == 'redis':
+        # optional dependency, only needed for the shared backend
+        import redis
+        return RedisBackend(redis.Redis.from_url(CACHE_REDIS_URL))
+    if name != 'memory':
+        raise ValueError(f'unknown cache backend: {name}')
+    return LRUBackend()
+
+
+# Response cache
+
+class ResponseCache:
+    '''
+    Read-through cache of serialized response bodies and their ETags.
+
+    Entity keys are deleted when the row is written. List pages are
+    keyed by a per-table generation that every write increments, so
+    pages cached before a write are never served after it. Their ETags
+    derive from the generation too and are known before a page is read.
+
+    The counters of a per-worker backend only count the writes of its
+    own worker. Given `generations`, a function returning the generation
+    of a table as kept by the database, such a cache keys entities by
+    it too, and the writes of every worker invalidate every worker's
+    entries.
+    '''
+
+    def __init__(self, backend, ttl=CACHE_TTL, enabled=CACHE_ENABLED,
+                 generations=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.enabled = enabled
+        self.generations = generations
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def database_generations(self):
+        return self.generations is not None and not self.backend.shared
+
+    def entity_key(self, table, id, generation=None):
+        if generation is not None and self.database_generations:
+            return f'{table}:{id}:{generation}'
+        return f'{table}:{id}'
+
+    def generation(self, table):
+        if self.database_generations:
+            return self.generations(table)
+        return self.backend.counter(f'{table}:generation')
+
+    def list_key(self, table, args, generation=None):
+        if generation is None:
+            generation = self.generation(table)
+        return f'{table}:list:{generation}:{args}'
+
+    def list_etag(self, table, args, generation=None):
+        '''
+        ETag of a list page, built from the generation of its table and
+        its query arguments, so it is known before the page is read.
+        None with a per-worker backend given no database generations,
+        whose own counters miss the writes of other workers; the page
+        is tagged with a hash of its body then.
+        '''
+        if self.backend.shared:
+            prefix = self.backend.epoch()
+        elif self.database_generations:
+            prefix = 'db'
+        else:
+            return None
+        if generation is None:
+            generation = self.generation(table)
+        digest = hashlib.sha1(f'{table}?{args}'.encode()).hexdigest()
+        return f'{prefix}.{generation}.{digest[:16]}'
+
+    def get(self, key):
+        '''
+        Returns the cached (body, etag) pair or None.
+        '''
+        if not self.enabled:
+            return None
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        etag, body = value.split(' ', 1)
+        return body, etag
+
+    def set(self, key, body, table=None, generation=None, etag=None):
+        '''
+        Caches a body and returns it with its ETag, a hash of the body
+        unless one is given. When the table was written since
+        `generation` was read the body may be stale, so it is returned
+        but not cached. Keys holding a database generation are never
+        read after a write and need no such check.
+        '''
+        etag = etag or hashlib.sha1(body.encode()).hexdigest()
+        if self.enabled and (table is None or self.database_generations
+                             or self.generation(table) == generation):
+            self.backend.set(key, f'{etag} {body}', self.ttl)
+        return body, etag
+
+    def invalidate(self, table, ids=()):
+        self.backend.incr(f'{table}:generation')
+        self.backend.delete(*[self.entity_key(table, id) for id in ids])
+
+    def mark_written(self, table, seconds):
+        '''
+        Remembers for `seconds` that `table` was just written.
+        '''
+        self.backend.set(f'{table}:written', '1', seconds)
+
+    def recently_written(self, table):
+        return self.backend.get(f'{table}:written') is not None
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+response_cache = ResponseCache(create_backend())
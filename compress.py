@@ -0,0 +1,95 @@
+'''
+Negotiated compression of response bodies. gzip is always available,
+brotli is preferred when the client accepts it and the brotli package
+is installed. Bodies below COMPRESS_MIN_SIZE bytes are sent as they are.
+'''
+import gzip
+import os
+
+from werkzeug.http import parse_accept_header
+
+
+COMPRESS_ENABLED = os.environ.get('COMPRESS_ENABLED', '1') != '0'
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 4))
+COMPRESSIBLE = ('application/json', 'text/plain')
+
+try:
+    # optional dependency, only needed for brotli
+    import brotli
+except ImportError:
+    brotli = None
+
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def choose_encoding(accept_encoding):
+    '''
+    The encoding to send for an Accept-Encoding header, None for the
+    identity.
+    '''
+    if not accept_encoding:
+        return None
+    return parse_accept_header(accept_encoding).best_match(ENCODINGS)
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, COMPRESS_LEVEL)
+
+
+def encode(data, accept_encoding, min_size=COMPRESS_MIN_SIZE):
+    '''
+    Returns `data` compressed for an Accept-Encoding header and the
+    encoding used, None when it is sent as it is.
+    '''
+    encoding = choose_encoding(accept_encoding) if COMPRESS_ENABLED else None
+    if encoding is None or len(data) < min_size:
+        return data, None
+    return compress(data, encoding), encoding
+
+
+def encoded_etag(tag, encoding):
+    '''
+    The strong ETag of the encoded body. The bytes differ from the
+    identity body, so the tag does too.
+    '''
+    return f'{tag}-{encoding}'
+
+
+def decoded_etag(tag):
+    '''
+    The ETag of the identity body from a tag sent back by a client.
+    '''
+    for encoding in ('br', 'gzip'):
+        if tag.endswith(f'-{encoding}'):
+            return tag[:-len(encoding) - 1]
+    return tag
+
+
+def compress_response(response, accept_encoding,
+                      min_size=COMPRESS_MIN_SIZE):
+    '''
+    Compresses a buffered Flask response in place. Streamed responses,
+    e.g. NDJSON lists and server-sent events, are left alone so they
+    keep flushing as they are generated.
+    '''
+    if not COMPRESS_ENABLED or response.is_streamed \
+            or response.direct_passthrough \
+            or response.mimetype not in COMPRESSIBLE \
+            or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200:
+        return response
+    data, encoding = encode(response.get_data(), accept_encoding, min_size)
+    if encoding is None:
+        return response
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    tag, weak = response.get_etag()
+    if tag:
+        response.set_etag(encoded_etag(tag, encoding), weak)
+    return response
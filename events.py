@@ -0,0 +1,231 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+
+EVENTS_BACKEND = os.environ.get('EVENTS_BACKEND', 'memory')
+EVENTS_REDIS_URL = os.environ.get('EVENTS_REDIS_URL',
+                                  'redis://localhost:6379/0')
+EVENTS_QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE', 100))
+EVENTS_HEARTBEAT = float(os.environ.get('EVENTS_HEARTBEAT', 15))
+EVENTS_MAX_SUBSCRIBERS = int(os.environ.get('EVENTS_MAX_SUBSCRIBERS', 100))
+# seconds before the redis relay reconnects, doubled up to the maximum
+EVENTS_RECONNECT_DELAY = float(os.environ.get('EVENTS_RECONNECT_DELAY', 0.5))
+EVENTS_RECONNECT_MAX_DELAY = float(
+    os.environ.get('EVENTS_RECONNECT_MAX_DELAY', 30))
+
+logger = logging.getLogger(__name__)
+
+# queued in place of the events a slow subscriber could not take
+OVERFLOW = object()
+
+
+class Subscription:
+    '''
+    Bounded queue of the events of one client. Publishing never waits:
+    when the queue is full the subscription overflows, the client is
+    told to resync from GET /changes and is disconnected.
+    '''
+
+    def __init__(self, maxsize=EVENTS_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize)
+        self.overflowed = False
+
+    def put(self, event):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflow()
+
+    def overflow(self):
+        '''
+        Drops the queued events, the client resyncs instead.
+        '''
+        self.overflowed = True
+        # make room so the overflow marker is the next thing read
+        with self.queue.mutex:
+            self.queue.queue.clear()
+        self.queue.put_nowait(OVERFLOW)
+
+    def get(self, timeout=None):
+        '''
+        The next event, None after `timeout` seconds without one.
+        '''
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Broker:
+    '''
+    In-process fan-out of events to the subscriptions of this worker.
+    '''
+
+    def __init__(self, queue_size=EVENTS_QUEUE_SIZE,
+                 max_subscribers=EVENTS_MAX_SUBSCRIBERS):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        '''
+        Returns a new subscription, None when the worker already serves
+        max_subscribers clients.
+        '''
+        with self._lock:
+            if len(self.subscriptions) >= self.max_subscribers:
+                return None
+            subscription = Subscription(self.queue_size)
+            self.subscriptions.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, events):
+        self.deliver(events)
+
+    def deliver(self, events):
+        with self._lock:
+            subscriptions = list(self.subscriptions)
+        for event in events:
+            for subscription in subscriptions:
+                subscription.put(event)
+
+    def overflow_all(self):
+        '''
+        Tells every client to resync, after events were lost.
+        '''
+        with self._lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            subscription.overflow()
+
+
+class RedisBroker(Broker):
+    '''
+    Broker relaying events through a redis pub/sub channel, so the
+    clients of every worker see the commits of all of them. Anything
+    with publish() and a pubsub() supporting subscribe, listen and close
+    can stand in for the redis-py client.
+
+    When the channel is lost the relay reconnects, waiting
+    `reconnect_delay` seconds, twice as long after every failed attempt
+    up to `max_reconnect_delay`. Events published meanwhile never
+    arrive, so the clients of the worker get an overflow and resync,
+    and no new client is taken until the channel is back.
+    '''
+
+    def __init__(self, client, channel='casting:events',
+                 reconnect_delay=EVENTS_RECONNECT_DELAY,
+                 max_reconnect_delay=EVENTS_RECONNECT_MAX_DELAY, **options):
+        super().__init__(**options)
+        self.client = client
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.listener = None
+        self.connected = False
+        self._listener_lock = threading.Lock()
+
+    def subscribe(self):
+        self.listen()
+        if not self.connected:
+            return None
+        return super().subscribe()
+
+    def publish(self, events):
+        self.client.publish(self.channel, json.dumps(events))
+
+    def listen(self):
+        '''
+        Starts the thread relaying the channel to local subscribers.
+        '''
+        with self._listener_lock:
+            if self.listener is not None:
+                return
+            pubsub = self.connect()
+            self.listener = threading.Thread(
+                target=self.relay, args=(pubsub,), name='events-relay',
+                daemon=True)
+            self.listener.start()
+
+    def connect(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        self.connected = True
+        return pubsub
+
+    def relay(self, pubsub):
+        delay = self.reconnect_delay
+        while True:
+            if pubsub is not None:
+                try:
+                    for message in pubsub.listen():
+                        delay = self.reconnect_delay
+                        if message['type'] == 'message':
+                            self.deliver(json.loads(message['data']))
+                except Exception:
+                    logger.warning('events channel lost, reconnecting',
+                                   exc_info=True)
+                self.connected = False
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+                self.overflow_all()
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+            try:
+                pubsub = self.connect()
+            except Exception:
+                logger.warning('events channel reconnect failed',
+                               exc_info=True)
+                pubsub = None
+
+
+def create_broker(name=EVENTS_BACKEND):
+    if name == 'redis':
+        # optional dependency, only needed for the shared broker
+        import redis
+        return RedisBroker(redis.Redis.from_url(EVENTS_REDIS_URL))
+    if name != 'memory':
+        raise ValueError(f'unknown events backend: {name}')
+    return Broker()
+
+
+def format_event(event):
+    return f'event: change\ndata: {json.dumps(event)}\n\n'
+
+
+def event_stream(broker, subscription, heartbeat=EVENTS_HEARTBEAT):
+    '''
+    Server-sent events of a subscription. A comment line is sent after
+    `heartbeat` idle seconds to keep proxies from closing the connection
+    and to notice clients that left. Unsubscribes when the client
+    disconnects or overflows.
+    '''
+    try:
+        yield 'retry: 5000\n\n'
+        while True:
+            event = subscription.get(heartbeat)
+            if event is None:
+                yield ': heartbeat\n\n'
+            elif event is OVERFLOW:
+                yield 'event: overflow\ndata: {}\n\n'
+                return
+            else:
+                yield format_event(event)
+    finally:
+        broker.unsubscribe(subscription)
+
+
+broker = create_broker()
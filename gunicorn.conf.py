@@ -0,0 +1,37 @@
+'''
+Gunicorn settings, read by `gunicorn api:app` from this directory.
+
+With preload_app the master imports and builds the app once and every
+worker is forked from it ready to serve, instead of importing Flask,
+SQLAlchemy and the app on its own.
+
+Workers are threaded. Every open GET /events stream holds a thread for
+as long as its client stays, so a worker has a thread for each of its
+EVENTS_MAX_SUBSCRIBERS streams plus GUNICORN_REQUEST_THREADS for the
+other requests. Idle threads are only started when needed.
+'''
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY',
+                             multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get(
+    'GUNICORN_THREADS',
+    int(os.environ.get('EVENTS_MAX_SUBSCRIBERS', 100))
+    + int(os.environ.get('GUNICORN_REQUEST_THREADS', 8))))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+
+def post_fork(server, worker):
+    '''
+    A connection the master opened while preloading would be shared by
+    every worker forked from it. Each worker drops the inherited pools
+    and opens connections of its own.
+    '''
+    import api
+    from models import engines
+    with api.app.app_context():
+        for engine in engines(api.app).values():
+            engine.dispose()
@@ -0,0 +1,122 @@
+'''
+Load test comparing serving modes, e.g. the sync gunicorn workers
+against the async uvicorn app:
+
+    gunicorn -w 4 -b 127.0.0.1:8000 api:app
+    uvicorn --workers 4 --port 8001 asgi:app
+    python loadtest.py --token $assistant_token \
+        --target sync=http://127.0.0.1:8000 \
+        --target async=http://127.0.0.1:8001 \
+        --path /artists --path /movies/1 --concurrency 64 --duration 30
+
+Each of `concurrency` threads keeps one connection open and sends
+requests back to back, so the offered load is fixed by the concurrency.
+'''
+import argparse
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p95_ms': ms(percentile(latencies, 0.95)),
+        'p99_ms': ms(percentile(latencies, 0.99))
+    }
+
+
+def run(url, headers=None, concurrency=16, duration=10):
+    '''
+    Sends GET requests to `url` for `duration` seconds and returns the
+    throughput and latency percentiles.
+    '''
+    parts = urlsplit(url)
+    connection_class = http.client.HTTPSConnection \
+        if parts.scheme == 'https' else http.client.HTTPConnection
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        connection = connection_class(parts.hostname, parts.port, timeout=30)
+        local_latencies = []
+        local_errors = 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path, headers=headers or {})
+                response = connection.getresponse()
+                response.read()
+                failed = response.status >= 400
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                failed = True
+            local_latencies.append(time.perf_counter() - start)
+            local_errors += failed
+        connection.close()
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, errors[0], time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--target', action='append', required=True,
+                        help='name=base_url, repeat to compare servers')
+    parser.add_argument('--path', action='append', required=True)
+    parser.add_argument('--token', help='bearer token')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+
+    headers = {'Authorization': f'Bearer {args.token}'} if args.token else {}
+    results = []
+    for target in args.target:
+        name, base_url = target.split('=', 1)
+        for path in args.path:
+            result = run(base_url.rstrip('/') + path, headers,
+                         args.concurrency, args.duration)
+            result.update(target=name, path=path)
+            results.append(result)
+            print(f"{name:>8} {path:<24} {result['rps']:>9} rps  "
+                  f"p50 {result['p50_ms']} ms  p99 {result['p99_ms']} ms  "
+                  f"errors {result['errors']}")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
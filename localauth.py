@@ -0,0 +1,128 @@
+'''
+Local RS256 signing key and tokens for offline tests and benchmarks.
+
+    python localauth.py --keys .keys producer
+
+writes the private key, its JWKS document and its public key to .keys
+and prints a token of the producer role. With JWKS_FILE=.keys/jwks.json,
+or KEY_PROVIDER=pem and PEM_KEYS_DIR=.keys/public, the API verifies
+these tokens offline.
+'''
+import argparse
+import base64
+import json
+import os
+import time
+
+import rsa
+from jose import jwt
+
+KID = 'local'
+
+ASSISTANT = ('get:artist', 'get:artists', 'get:movie', 'get:movies')
+DIRECTOR = ASSISTANT + ('post:artist', 'delete:artist', 'patch:artist',
+                        'patch:movie')
+PRODUCER = DIRECTOR + ('post:movie', 'delete:movie')
+
+ROLES = {
+    'assistant': ASSISTANT,
+    'director': DIRECTOR,
+    'producer': PRODUCER
+}
+
+
+def b64_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+class LocalKey:
+    '''
+    RSA key pair that signs tokens and publishes its public half as a
+    JWKS document.
+    '''
+
+    def __init__(self, private_pem, kid=KID):
+        self.private_pem = private_pem
+        self.kid = kid
+        self._private = rsa.PrivateKey.load_pkcs1(private_pem.encode())
+
+    @classmethod
+    def generate(cls, bits=2048, kid=KID):
+        _, private = rsa.newkeys(bits)
+        return cls(private.save_pkcs1().decode(), kid)
+
+    @classmethod
+    def load(cls, directory, kid=KID):
+        '''
+        Loads the key saved in `directory`, generating it on first use.
+        '''
+        path = os.path.join(directory, 'private.pem')
+        if not os.path.exists(path):
+            return cls.generate(kid=kid).save(directory)
+        with open(path) as pem_file:
+            return cls(pem_file.read(), kid)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'private.pem'), 'w') as pem_file:
+            pem_file.write(self.private_pem)
+        with open(self.jwks_path(directory), 'w') as jwks_file:
+            json.dump(self.jwks(), jwks_file)
+        public = os.path.join(directory, 'public')
+        os.makedirs(public, exist_ok=True)
+        with open(os.path.join(public, f'{self.kid}.pem'), 'w') as pem_file:
+            pem_file.write(self.public_pem())
+        return self
+
+    @staticmethod
+    def jwks_path(directory):
+        return os.path.join(directory, 'jwks.json')
+
+    def jwks(self):
+        return {'keys': [{
+            'kty': 'RSA',
+            'use': 'sig',
+            'alg': 'RS256',
+            'kid': self.kid,
+            'n': b64_uint(self._private.n),
+            'e': b64_uint(self._private.e)
+        }]}
+
+    def public_pem(self):
+        public = rsa.PublicKey(self._private.n, self._private.e)
+        return public.save_pkcs1().decode()
+
+    def mint_token(self, permissions=PRODUCER, subject='local|bench',
+                   lifetime=3600, **claims):
+        '''
+        Returns a token with the issuer and audience the API expects.
+        '''
+        # imported here so JWKS_FILE can be set before auth is loaded
+        from auth import API_AUDIENCE, JWT_ISSUER
+        now = int(time.time())
+        claims = dict({
+            'iss': JWT_ISSUER,
+            'sub': subject,
+            'aud': API_AUDIENCE,
+            'iat': now,
+            'exp': now + lifetime,
+            'permissions': list(permissions)
+        }, **claims)
+        return jwt.encode(claims, self.private_pem, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--keys', default='.keys',
+                        help='directory of private.pem and jwks.json')
+    parser.add_argument('role', choices=sorted(ROLES), nargs='?',
+                        default='producer')
+    args = parser.parse_args()
+    key = LocalKey.load(args.keys)
+    print(key.mint_token(ROLES[args.role]))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,14 @@
-from flask_script import Manager
-from flask_migrate import Migrate, MigrateCommand
+'''
+The flask command with the app of api.create_app, so
+`python manage.py db upgrade` or `python manage.py import artists
+artists.csv` run without FLASK_APP.
+'''
+from flask.cli import FlaskGroup
 
-from api import app
-from models import db
+from api import create_app
 
-migrate = Migrate(app, db)
-manager = Manager(app)
-
-manager.add_command('db', MigrateCommand)
+cli = FlaskGroup(create_app=create_app)
 
 
 if __name__ == '__main__':
-    manager.run()
+    cli()
@@ -0,0 +1,240 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Prometheus default buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+# phases reported in the Server-Timing header, in this order
+PHASES = ('auth', 'jwks', 'db', 'serialize')
+
+
+# Connection pool
+
+class TimedQueuePool(QueuePool):
+    '''
+    QueuePool that measures how long checkouts wait for a connection.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.timeouts += timed_out
+                self.wait_seconds_total += waited
+                self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+    def stats(self):
+        capacity = self.size() + max(self._max_overflow, 0)
+        return {
+            'size': self.size(),
+            'checked_out': self.checkedout(),
+            'overflow': max(self.overflow(), 0),
+            'saturation': self.checkedout() / capacity if capacity else 0,
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'wait_seconds_total': self.wait_seconds_total,
+            'wait_seconds_max': self.wait_seconds_max
+        }
+
+
+POOL_METRICS = (
+    ('db_pool_size', 'gauge', 'size', 'Connections kept in the pool'),
+    ('db_pool_checked_out', 'gauge', 'checked_out',
+     'Connections currently checked out'),
+    ('db_pool_overflow', 'gauge', 'overflow',
+     'Overflow connections currently open'),
+    ('db_pool_saturation', 'gauge', 'saturation',
+     'Checked out connections over pool size plus max overflow'),
+    ('db_pool_checkouts_total', 'counter', 'checkouts',
+     'Connection checkouts'),
+    ('db_pool_timeouts_total', 'counter', 'timeouts',
+     'Checkouts that timed out waiting for a connection'),
+    ('db_pool_checkout_wait_seconds_total', 'counter', 'wait_seconds_total',
+     'Time spent waiting for a connection'),
+    ('db_pool_checkout_wait_seconds_max', 'gauge', 'wait_seconds_max',
+     'Longest wait for a connection'),
+)
+
+
+def pool_metrics(engines):
+    '''
+    Pool metrics of the given {bind: engine} mapping, for render().
+    '''
+    stats = {bind: engine.pool.stats() for bind, engine in engines.items()
+             if isinstance(engine.pool, TimedQueuePool)}
+    return [(name, kind, description,
+             [({'bind': bind}, pool[key]) for bind, pool in stats.items()])
+            for name, kind, key, description in POOL_METRICS]
+
+
+# Request timing
+
+@contextmanager
+def phase(name):
+    '''
+    Adds the time spent in the block to the `name` phase of the current
+    request. Outside of a request the block just runs.
+    '''
+    if not has_request_context():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = g.setdefault('timings', {})
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    # keyed by cursor, a statement that fails never reaches
+    # after_cursor_execute and is dropped by handle_error instead
+    conn.info.setdefault('query_start', {})[cursor] = time.perf_counter()
+
+
+def handle_error(exception_context):
+    conn, cursor = exception_context.connection, exception_context.cursor
+    if cursor is None and exception_context.execution_context is not None:
+        cursor = exception_context.execution_context.cursor
+    if conn is not None and cursor is not None:
+        conn.info.get('query_start', {}).pop(cursor, None)
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    start = conn.info['query_start'].pop(cursor)
+    if not has_request_context():
+        return
+    timings = g.setdefault('timings', {})
+    timings['db'] = timings.get('db', 0.0) + time.perf_counter() - start
+    g.queries = g.get('queries', 0) + 1
+    # rows written, or read where the driver reports it (psycopg2 does)
+    if cursor.rowcount > 0:
+        g.rows = g.get('rows', 0) + cursor.rowcount
+
+
+def instrument_queries():
+    '''
+    Times every SQL statement and counts statements and rows per request.
+    '''
+    if not event.contains(Engine, 'before_cursor_execute',
+                          before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(Engine, 'handle_error', handle_error)
+
+
+def server_timing(timings, total, queries=0, rows=0):
+    '''
+    Server-Timing header value of the phase durations, in milliseconds.
+    '''
+    metrics = []
+    for name in PHASES:
+        if name not in timings:
+            continue
+        metric = f'{name};dur={timings[name] * 1000:.3f}'
+        if name == 'db':
+            metric += f';desc="{queries} queries, {rows} rows"'
+        metrics.append(metric)
+    metrics.append(f'total;dur={total * 1000:.3f}')
+    return ', '.join(metrics)
+
+
+class Histogram:
+    '''
+    Prometheus histogram with one series per label set.
+    '''
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._series.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._series[key] = (counts, total + value)
+
+    def metric(self):
+        '''
+        The histogram as a (name, type, help, samples) tuple for render().
+        '''
+        samples = []
+        with self._lock:
+            series = sorted((key, list(counts), total)
+                            for key, (counts, total) in self._series.items())
+        for key, counts, total in series:
+            labels = dict(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else str(bound)
+                samples.append(('_bucket', dict(labels, le=le), cumulative))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, cumulative))
+        return self.name, 'histogram', self.description, samples
+
+
+request_latency = Histogram('http_request_duration_seconds',
+                            'Request latency by route')
+
+
+# Prometheus text format
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"'
+                          for name, value in sorted(labels.items())) + '}'
+
+
+def render(metrics):
+    '''
+    Renders (name, type, help, [(labels, value)]) tuples in the
+    Prometheus text exposition format. Histogram samples are
+    (suffix, labels, value) triples.
+    '''
+    lines = []
+    for name, kind, description, samples in metrics:
+        if not samples:
+            continue
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for sample in samples:
+            suffix, labels, value = sample if len(sample) == 3 \
+                else ('',) + tuple(sample)
+            lines.append(f'{name}{suffix}{format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,39 @@
+"""add Performances table
+
+Revision ID: 5b1f3c9d2a47
+Revises: df0c00c7ddfb
+Create Date: 2026-10-18 18:20:11.412093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1f3c9d2a47'
+down_revision = 'df0c00c7ddfb'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('Performances',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('artist_id', sa.Integer(), nullable=False),
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['artist_id'], ['Artists.id'], ),
+    sa.ForeignKeyConstraint(['movie_id'], ['Movies.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_Performances_movie_id_artist_id', 'Performances',
+                    ['movie_id', 'artist_id'], unique=True)
+    op.create_index('ix_Performances_artist_id_movie_id', 'Performances',
+                    ['artist_id', 'movie_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_Performances_artist_id_movie_id',
+                  table_name='Performances')
+    op.drop_index('ix_Performances_movie_id_artist_id',
+                  table_name='Performances')
+    op.drop_table('Performances')
@@ -0,0 +1,46 @@
+"""search indexes on Artists and Movies
+
+Revision ID: 8e2d4a6c1f90
+Revises: 5b1f3c9d2a47
+Create Date: 2026-10-18 18:41:37.206514
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e2d4a6c1f90'
+down_revision = '5b1f3c9d2a47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # B-tree indexes for range filters and keyset sorts, id breaks ties
+    op.create_index('ix_Artists_age', 'Artists', ['age', 'id'])
+    op.create_index('ix_Artists_gender', 'Artists', ['gender', 'id'])
+    op.create_index('ix_Artists_name', 'Artists', ['name', 'id'])
+    op.create_index('ix_Movies_release_date', 'Movies', ['release_date', 'id'])
+    op.create_index('ix_Movies_title', 'Movies', ['title', 'id'])
+
+    # trigram indexes serve the ILIKE '%...%' name and title search
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        op.create_index('ix_Artists_name_trgm', 'Artists', ['name'],
+                        postgresql_using='gin',
+                        postgresql_ops={'name': 'gin_trgm_ops'})
+        op.create_index('ix_Movies_title_trgm', 'Movies', ['title'],
+                        postgresql_using='gin',
+                        postgresql_ops={'title': 'gin_trgm_ops'})
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.drop_index('ix_Movies_title_trgm', table_name='Movies')
+        op.drop_index('ix_Artists_name_trgm', table_name='Artists')
+    op.drop_index('ix_Movies_title', table_name='Movies')
+    op.drop_index('ix_Movies_release_date', table_name='Movies')
+    op.drop_index('ix_Artists_name', table_name='Artists')
+    op.drop_index('ix_Artists_gender', table_name='Artists')
+    op.drop_index('ix_Artists_age', table_name='Artists')
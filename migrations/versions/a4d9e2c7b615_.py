@@ -0,0 +1,29 @@
+"""Generations of the tables, read by per-worker response caches
+
+Revision ID: a4d9e2c7b615
+Revises: b7e4c2a9d318
+Create Date: 2026-10-18 23:52:14.306117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d9e2c7b615'
+down_revision = 'b7e4c2a9d318'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('Generations',
+    sa.Column('table_name', sa.String(length=20), nullable=False),
+    sa.Column('generation', sa.Integer(), server_default='0',
+              nullable=False),
+    sa.PrimaryKeyConstraint('table_name')
+    )
+
+
+def downgrade():
+    op.drop_table('Generations')
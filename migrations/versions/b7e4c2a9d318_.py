@@ -0,0 +1,61 @@
+"""CastCounts and FilmCounts summaries of Performances
+
+Revision ID: b7e4c2a9d318
+Revises: f1c4a8e6b392
+Create Date: 2026-10-18 22:41:07.218554
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e4c2a9d318'
+down_revision = 'f1c4a8e6b392'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('CastCounts',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('cast_count', sa.Integer(), server_default='0',
+              nullable=False),
+    sa.ForeignKeyConstraint(['id'], ['Movies.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_CastCounts_cast_count', 'CastCounts',
+                    ['cast_count', 'id'])
+    op.create_table('FilmCounts',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('film_count', sa.Integer(), server_default='0',
+              nullable=False),
+    sa.ForeignKeyConstraint(['id'], ['Artists.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_FilmCounts_film_count', 'FilmCounts',
+                    ['film_count', 'id'])
+    # a performance counts while both its movie and artist are live
+    op.execute('''
+        INSERT INTO "CastCounts" (id, cast_count)
+        SELECT m.id, COUNT(a.id) FROM "Movies" m
+        LEFT JOIN "Performances" p ON p.movie_id = m.id
+        LEFT JOIN "Artists" a ON a.id = p.artist_id AND a.deleted_at IS NULL
+        WHERE m.deleted_at IS NULL
+        GROUP BY m.id
+    ''')
+    op.execute('''
+        INSERT INTO "FilmCounts" (id, film_count)
+        SELECT a.id, COUNT(m.id) FROM "Artists" a
+        LEFT JOIN "Performances" p ON p.artist_id = a.id
+        LEFT JOIN "Movies" m ON m.id = p.movie_id AND m.deleted_at IS NULL
+        WHERE a.deleted_at IS NULL
+        GROUP BY a.id
+    ''')
+
+
+def downgrade():
+    op.drop_index('ix_FilmCounts_film_count', table_name='FilmCounts')
+    op.drop_table('FilmCounts')
+    op.drop_index('ix_CastCounts_cast_count', table_name='CastCounts')
+    op.drop_table('CastCounts')
@@ -0,0 +1,29 @@
+"""version column on Artists and Movies
+
+Revision ID: c3a7e9b1d205
+Revises: 8e2d4a6c1f90
+Create Date: 2026-10-18 20:12:09.418730
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3a7e9b1d205'
+down_revision = '8e2d4a6c1f90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing rows start at version 1
+    op.add_column('Artists', sa.Column('version', sa.Integer(),
+                                       server_default='1', nullable=False))
+    op.add_column('Movies', sa.Column('version', sa.Integer(),
+                                      server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('Movies', 'version')
+    op.drop_column('Artists', 'version')
@@ -0,0 +1,64 @@
+"""ON DELETE CASCADE on Performances, deleted_at on Artists and Movies
+
+Revision ID: e5b8d2f4a613
+Revises: c3a7e9b1d205
+Create Date: 2026-10-18 20:47:52.130564
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b8d2f4a613'
+down_revision = 'c3a7e9b1d205'
+branch_labels = None
+depends_on = None
+
+
+def performances_table(ondelete):
+    return sa.Table(
+        'Performances', sa.MetaData(),
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('artist_id', sa.Integer(), nullable=False),
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['artist_id'], ['Artists.id'],
+                                name='Performances_artist_id_fkey',
+                                ondelete=ondelete),
+        sa.ForeignKeyConstraint(['movie_id'], ['Movies.id'],
+                                name='Performances_movie_id_fkey',
+                                ondelete=ondelete),
+        sa.PrimaryKeyConstraint('id'),
+        sa.Index('ix_Performances_movie_id_artist_id',
+                 'movie_id', 'artist_id', unique=True),
+        sa.Index('ix_Performances_artist_id_movie_id',
+                 'artist_id', 'movie_id')
+    )
+
+
+def replace_foreign_keys(ondelete):
+    if op.get_bind().dialect.name != 'postgresql':
+        # SQLite can't alter constraints, the table is copied instead
+        with op.batch_alter_table('Performances', recreate='always',
+                                  copy_from=performances_table(ondelete)):
+            pass
+        return
+    for column, table in (('artist_id', 'Artists'), ('movie_id', 'Movies')):
+        name = f'Performances_{column}_fkey'
+        op.drop_constraint(name, 'Performances', type_='foreignkey')
+        op.create_foreign_key(name, 'Performances', table, [column], ['id'],
+                              ondelete=ondelete)
+
+
+def upgrade():
+    replace_foreign_keys('CASCADE')
+    op.add_column('Artists', sa.Column('deleted_at', sa.DateTime(),
+                                       nullable=True))
+    op.add_column('Movies', sa.Column('deleted_at', sa.DateTime(),
+                                      nullable=True))
+
+
+def downgrade():
+    op.drop_column('Movies', 'deleted_at')
+    op.drop_column('Artists', 'deleted_at')
+    replace_foreign_keys(None)
@@ -0,0 +1,41 @@
+"""updated_at on Artists and Movies, Changes log
+
+Revision ID: f1c4a8e6b392
+Revises: e5b8d2f4a613
+Create Date: 2026-10-18 21:26:40.583117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1c4a8e6b392'
+down_revision = 'e5b8d2f4a613'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('Artists', sa.Column('updated_at', sa.DateTime(),
+                                       server_default=sa.func.now(),
+                                       nullable=False))
+    op.add_column('Movies', sa.Column('updated_at', sa.DateTime(),
+                                      server_default=sa.func.now(),
+                                      nullable=False))
+    op.create_table('Changes',
+    sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'),
+              nullable=False),
+    sa.Column('table_name', sa.String(length=20), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('operation', sa.String(length=6), nullable=False),
+    sa.Column('changed_at', sa.DateTime(), server_default=sa.func.now(),
+              nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('Changes')
+    op.drop_column('Movies', 'updated_at')
+    op.drop_column('Artists', 'updated_at')
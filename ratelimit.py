@@ -0,0 +1,293 @@
+import asyncio
+import fnmatch
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') != '0'
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL',
+                                      'redis://localhost:6379/0')
+# permission pattern=requests per second/burst, first match wins
+RATE_LIMITS = os.environ.get('RATE_LIMITS', 'get:*=50/100,*=5/20')
+RATE_LIMIT_KEYS = int(os.environ.get('RATE_LIMIT_KEYS', 10000))
+# requests served at once per worker, 0 for no cap
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('MAX_CONCURRENT_REQUESTS', 0))
+# seconds a request waits for a free slot before it is shed
+ADMISSION_TIMEOUT = float(os.environ.get('ADMISSION_TIMEOUT', 0))
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+
+
+class LimitExceeded(Exception):
+    '''
+    A request refused by the rate limiter, 429, or shed by admission
+    control, 503. `retry_after` is in whole seconds.
+    '''
+
+    def __init__(self, error, status_code, retry_after):
+        self.error = error
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def parse_limits(spec):
+    '''
+    Parses 'get:*=50/100,*=5/20' into (pattern, rate, burst) triples.
+    '''
+    limits = []
+    for item in filter(None, (item.strip() for item in spec.split(','))):
+        pattern, _, limit = item.partition('=')
+        rate, _, burst = limit.partition('/')
+        rate = float(rate)
+        limits.append((pattern.strip(), rate, int(burst or max(rate, 1))))
+    return limits
+
+
+# Backends
+#
+# Buckets are kept in the GCRA form: the time at which the bucket would
+# be full again. A request is admitted when that time, plus its own
+# cost, is within the burst of now. The state is a single number.
+#
+# A request draws from several buckets at once. Backends check them all
+# and only charge them when every one admits the request, so a request
+# refused by one bucket costs nothing in the others.
+
+def gcra(tat, now, interval, capacity):
+    '''
+    Returns the new arrival time and the seconds to wait, 0 when the
+    request is admitted.
+    '''
+    tat = max(tat if tat is not None else now, now) + interval
+    wait = tat - now - capacity
+    return tat, max(wait, 0)
+
+
+class MemoryBackend:
+    '''
+    In-process buckets, one set per worker. The least recently used
+    buckets are dropped beyond `maxsize`, which only refills them.
+    '''
+
+    # buckets of this worker only, checked without any I/O
+    shared = False
+
+    def __init__(self, maxsize=RATE_LIMIT_KEYS, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, buckets):
+        '''
+        Takes a request from each (key, interval, capacity) bucket if
+        all of them admit it. Returns the seconds to wait per bucket,
+        all 0 when the request is admitted.
+        '''
+        with self._lock:
+            now = self.clock()
+            results = [gcra(self._buckets.get(key), now, interval, capacity)
+                       for key, interval, capacity in buckets]
+            waits = [wait for _, wait in results]
+            if any(waits):
+                return waits
+            for (key, _, _), (tat, _) in zip(buckets, results):
+                self._buckets[key] = tat
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return waits
+
+
+GCRA_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local tats = {}
+local waits = {}
+local refused = false
+for i, key in ipairs(KEYS) do
+    local interval = tonumber(ARGV[2 * i])
+    local capacity = tonumber(ARGV[2 * i + 1])
+    local tat = math.max(tonumber(redis.call('GET', key) or now), now)
+    tats[i] = tat + interval
+    waits[i] = math.max(tats[i] - now - capacity, 0)
+    refused = refused or waits[i] > 0
+    waits[i] = tostring(waits[i])
+end
+if not refused then
+    for i, key in ipairs(KEYS) do
+        redis.call('SET', key, tostring(tats[i]), 'PX',
+                   math.ceil((tats[i] - now) * 1000) + 1000)
+    end
+end
+return waits
+'''
+
+
+class RedisBackend:
+    '''
+    Buckets shared by all workers, checked and charged atomically by a
+    script on a redis-py compatible client. Anything with
+    register_script can stand in.
+    '''
+    # buckets of every worker, a network round trip away
+    shared = True
+
+    def __init__(self, client, prefix='casting:rate:', clock=time.time):
+        self.prefix = prefix
+        self.clock = clock
+        self.script = client.register_script(GCRA_SCRIPT)
+
+    def acquire(self, buckets):
+        args = [self.clock()]
+        for _, interval, capacity in buckets:
+            args += [interval, capacity]
+        waits = self.script(keys=[self.prefix + key
+                                  for key, _, _ in buckets], args=args)
+        return [float(wait.decode() if isinstance(wait, bytes) else wait)
+                for wait in waits]
+
+
+def create_backend(name=RATE_LIMIT_BACKEND):
+    if name == 'redis':
+        # optional dependency, only needed for the shared backend
+        import redis
+        return RedisBackend(redis.Redis.from_url(RATE_LIMIT_REDIS_URL))
+    if name != 'memory':
+        raise ValueError(f'unknown rate limit backend: {name}')
+    return MemoryBackend()
+
+
+# Rate limiter
+
+class RateLimiter:
+    '''
+    Token buckets per token subject and permission. Each route draws
+    from the buckets of the permissions it requires, so writes and
+    reads, and thereby the roles holding them, get their own limits.
+    '''
+
+    def __init__(self, backend, limits=RATE_LIMITS,
+                 enabled=RATE_LIMIT_ENABLED):
+        self.backend = backend
+        self.limits = parse_limits(limits)
+        self.enabled = enabled
+
+    def limit(self, permission):
+        for pattern, rate, burst in self.limits:
+            if fnmatch.fnmatchcase(permission, pattern):
+                return rate, burst
+        return None
+
+    def check(self, subject, permissions):
+        '''
+        Admits a request of `subject` that needs `permissions`, or
+        raises LimitExceeded without charging any of its buckets.
+        '''
+        if not self.enabled:
+            return
+        buckets = []
+        for permission in sorted(permissions):
+            limit = self.limit(permission)
+            if limit is None:
+                continue
+            rate, burst = limit
+            if rate <= 0:
+                continue
+            interval = 1 / rate
+            buckets.append((permission, interval, burst * interval))
+        if not buckets:
+            return
+        waits = self.backend.acquire([
+            (f'{subject}:{permission}', interval, capacity)
+            for permission, interval, capacity in buckets])
+        refused = [(wait, permission) for wait, (permission, _, _)
+                   in zip(waits, buckets) if wait > 0]
+        if refused:
+            wait, permission = max(refused)
+            raise LimitExceeded({
+                'code': 'rate_limited',
+                'description': f'Too many requests for {permission}'
+            }, 429, math.ceil(wait))
+
+
+rate_limiter = RateLimiter(create_backend())
+
+
+# Admission control
+
+class Admission:
+    '''
+    Caps the requests a worker serves at once. A request that finds no
+    free slot within `timeout` seconds is shed with 503 instead of
+    queueing for a database connection.
+    '''
+
+    def __init__(self, limit=MAX_CONCURRENT_REQUESTS,
+                 timeout=ADMISSION_TIMEOUT,
+                 retry_after=ADMISSION_RETRY_AFTER):
+        self.limit = limit
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.shed = 0
+        self._slots = threading.BoundedSemaphore(limit) if limit else None
+
+    def __enter__(self):
+        if self._slots is None:
+            return self
+        if self.timeout > 0:
+            admitted = self._slots.acquire(timeout=self.timeout)
+        else:
+            admitted = self._slots.acquire(blocking=False)
+        if not admitted:
+            raise self.overloaded()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._slots is not None:
+            self._slots.release()
+
+    def overloaded(self):
+        self.shed += 1
+        return LimitExceeded({
+            'code': 'overloaded',
+            'description': 'Too many concurrent requests'
+        }, 503, self.retry_after)
+
+
+class AsyncAdmission(Admission):
+    '''
+    Admission control of the routes served on an event loop. A request
+    waits for its slot on an asyncio semaphore, so a saturated worker
+    keeps serving its other connections while it sheds load. The slots
+    are separate from those of the threads of the same worker.
+    '''
+
+    def __init__(self, limit=MAX_CONCURRENT_REQUESTS, **options):
+        super().__init__(limit, **options)
+        self._async_slots = asyncio.Semaphore(limit) if limit else None
+
+    async def __aenter__(self):
+        if self._async_slots is None:
+            return self
+        try:
+            if self.timeout > 0:
+                await asyncio.wait_for(self._async_slots.acquire(),
+                                       self.timeout)
+            elif self._async_slots.locked():
+                raise asyncio.TimeoutError()
+            else:
+                await self._async_slots.acquire()
+        except asyncio.TimeoutError:
+            raise self.overloaded()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self._async_slots is not None:
+            self._async_slots.release()
+
+
+admission = Admission()
+async_admission = AsyncAdmission()
@@ -0,0 +1,557 @@
+'''
+Bulk import and export of artists, movies and performances as CSV,
+NDJSON or Parquet files, run by `flask import` and `flask export`.
+
+Files are read and written TRANSFER_BATCH_SIZE rows at a time, so memory
+stays flat whatever their size. Every batch of an import is committed
+on its own: on PostgreSQL it is loaded with COPY, elsewhere with an
+executemany INSERT. After each commit the rows done so far are saved to
+a checkpoint file, and a run that failed or was stopped resumes from
+there. Rows keep the id they have in the file, rows without one get the
+next ids of the table. Those ids are saved to the checkpoint before the
+batch is committed, so a resumed run gives them to the same rows and
+skips the ones a stopped run inserted.
+'''
+import csv
+import io
+import itertools
+import json
+import os
+import sys
+import time
+from functools import wraps
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+from models import (Artists, Movies, Performances, chunked, db, live,
+                    track_counts, track_events, track_write, validate,
+                    INSERT)
+
+TRANSFER_BATCH_SIZE = int(os.environ.get('TRANSFER_BATCH_SIZE', 10000))
+
+TABLES = {
+    'artists': Artists,
+    'movies': Movies,
+    'performances': Performances
+}
+FORMATS = ('csv', 'ndjson', 'parquet')
+EXTENSIONS = {
+    '.csv': 'csv',
+    '.ndjson': 'ndjson',
+    '.jsonl': 'ndjson',
+    '.parquet': 'parquet'
+}
+
+try:
+    # optional dependency, only needed for Parquet files
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class TransferError(Exception):
+    '''
+    A file that can't be imported or exported, with the reason.
+    '''
+
+
+def file_errors(f):
+    '''
+    Reports a file of a transfer that can't be opened, read or written
+    as a TransferError naming its path.
+    '''
+    @wraps(f)
+    def wrapper(table, path, *args, **kwargs):
+        try:
+            return f(table, path, *args, **kwargs)
+        except OSError as error:
+            raise TransferError(f'{error.filename or path}: '
+                                f'{error.strerror or error}') from error
+    return wrapper
+
+
+def file_format(path, fmt=None):
+    fmt = fmt or EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if fmt not in FORMATS:
+        raise TransferError(f'unknown format of {path}, use one of '
+                            + ', '.join(FORMATS))
+    if fmt == 'parquet' and pyarrow is None:
+        raise TransferError('Parquet files need the pyarrow package')
+    return fmt
+
+
+def is_postgresql():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def quoted(model, fields=()):
+    '''
+    The quoted table name of `model` and the quoted `fields`, for
+    statements written by hand.
+    '''
+    preparer = db.session.get_bind().dialect.identifier_preparer
+    return preparer.format_table(model.__table__), \
+        ', '.join(preparer.quote(field) for field in fields)
+
+
+def report(table, rows, total, seconds):
+    '''
+    Default progress callback, one line on stderr per batch.
+    '''
+    done = f'{rows}/{total}' if total is not None else str(rows)
+    rate = rows / seconds if seconds > 0 else 0
+    print(f'{table}: {done} rows, {rate:.0f} rows/s', file=sys.stderr)
+
+
+# Checkpoints
+
+def load_checkpoint(path, table):
+    '''
+    The state saved by an earlier run on the same table, None when
+    there is none.
+    '''
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        state = json.load(file)
+    if state.get('table') != table:
+        raise TransferError(f'{path} is a checkpoint of {state.get("table")}'
+                            f', not {table}')
+    return state
+
+
+def save_checkpoint(path, state):
+    # written aside and renamed, a crash never leaves half a checkpoint
+    with open(path + '.tmp', 'w') as file:
+        json.dump(state, file)
+    os.replace(path + '.tmp', path)
+
+
+def clear_checkpoint(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+# Reading
+
+def read_csv(path):
+    with open(path, newline='', encoding='utf-8') as file:
+        yield from csv.DictReader(file)
+
+
+def read_ndjson(path):
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_parquet(path, batch_size):
+    parquet = pyarrow.parquet.ParquetFile(path)
+    for batch in parquet.iter_batches(batch_size):
+        yield from batch.to_pylist()
+
+
+def read_rows(path, fmt, batch_size):
+    if fmt == 'csv':
+        return read_csv(path)
+    if fmt == 'ndjson':
+        return read_ndjson(path)
+    return read_parquet(path, batch_size)
+
+
+def count_rows(path, fmt):
+    '''
+    Rows in the file when that is known without reading it, for the
+    progress report.
+    '''
+    if fmt == 'parquet':
+        return pyarrow.parquet.ParquetFile(path).metadata.num_rows
+    return None
+
+
+def coerce(model, item, number):
+    '''
+    The row of a file item to insert. CSV fields are strings and empty
+    ones are NULL, so values are converted to the column types first.
+    '''
+    if not isinstance(item, dict):
+        raise TransferError(f'row {number}: item must be an object')
+    row = {}
+    for field, value in item.items():
+        if field not in model.FIELDS:
+            raise TransferError(f'row {number}: unknown field {field}')
+        if value == '':
+            value = None
+        python_type = model.__table__.c[field].type.python_type
+        if isinstance(value, str) and python_type is int:
+            try:
+                value = int(value)
+            except ValueError:
+                raise TransferError(f'row {number}: {field} must be int')
+        row[field] = value
+    error = validate(model, {field: value for field, value in row.items()
+                             if field != 'id'})
+    if error is None and row.get('id') is not None \
+            and (not isinstance(row['id'], int)
+                 or isinstance(row['id'], bool)):
+        error = 'id must be int'
+    if error:
+        raise TransferError(f'row {number}: {error}')
+    return {field: row.get(field) for field in model.FIELDS}
+
+
+# Writing to the database
+
+def allocate_ids(model, rows):
+    '''
+    Gives ids to the rows without one, so every inserted row is known
+    to the cache, the change log and the event stream.
+    '''
+    missing = [row for row in rows if row['id'] is None]
+    if not missing:
+        return
+    table = model.__table__
+    if is_postgresql():
+        sequence = func.pg_get_serial_sequence(quoted(model)[0], 'id')
+        ids = [id for id, in db.session.execute(
+            select([func.nextval(sequence)])
+            .select_from(func.generate_series(1, len(missing))))]
+    else:
+        start = db.session.execute(
+            select([func.coalesce(func.max(table.c.id), 0)])).scalar()
+        start = max([start] + [row['id'] for row in rows
+                               if row['id'] is not None])
+        ids = range(start + 1, start + len(missing) + 1)
+    for row, id in zip(missing, ids):
+        row['id'] = id
+
+
+def present_ids(model, ids):
+    '''
+    The ids of rows in the table, soft deleted ones included.
+    '''
+    table = model.__table__
+    ids = [id for id in ids if id is not None]
+    return {id for id, in db.session.execute(
+        select([table.c.id]).where(table.c.id.in_(ids)))} if ids else set()
+
+
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(model, rows):
+    '''
+    Loads rows with COPY FROM STDIN in its text format, on the
+    connection of the session so it is part of its transaction.
+    '''
+    table, fields = quoted(model, model.FIELDS)
+    data = io.StringIO(''.join(
+        '\t'.join(copy_value(row[field]) for field in model.FIELDS) + '\n'
+        for row in rows))
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(f'COPY {table} ({fields}) FROM STDIN', data)
+
+
+def advance_sequence(model):
+    # ids from the file bypass the sequence, move it past them
+    table, _ = quoted(model)
+    sequence = func.pg_get_serial_sequence(table, 'id')
+    db.session.execute(select([func.setval(sequence, func.greatest(
+        func.nextval(sequence),
+        select([func.max(model.__table__.c.id)]).as_scalar()))]))
+
+
+def insert_batch(model, rows):
+    '''
+    Inserts one batch and commits it. Writes are tracked as those of
+    the API are, so cached responses are invalidated and subscribers
+    of GET /events and GET /changes see the new rows.
+    '''
+    try:
+        if is_postgresql():
+            copy_rows(model, rows)
+            advance_sequence(model)
+        else:
+            db.session.execute(model.__table__.insert(), rows)
+        if model is Performances:
+            ids = [row['id'] for row in rows]
+            for chunk in chunked(ids):
+                track_counts(Performances.id.in_(chunk), 1)
+            track_events(dict(row, type=model.__tablename__,
+                              operation=INSERT) for row in rows)
+        else:
+            track_write(model, [row['id'] for row in rows], INSERT)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+@file_errors
+def import_file(table, path, fmt=None, batch_size=TRANSFER_BATCH_SIZE,
+                checkpoint=None, restart=False, progress=report):
+    '''
+    Imports a file into `table`, resuming from its checkpoint unless
+    `restart` is set. Returns the rows imported by this run.
+    '''
+    model = TABLES[table]
+    fmt = file_format(path, fmt)
+    checkpoint = checkpoint or path + '.checkpoint'
+    if restart:
+        clear_checkpoint(checkpoint)
+    state = load_checkpoint(checkpoint, table)
+    # a checkpoint left by an earlier run, even at 0 rows, means its
+    # next batch may have been committed already
+    resumed = state is not None
+    if state is None:
+        state = {'table': table, 'rows': 0}
+        save_checkpoint(checkpoint, state)
+    done = state['rows']
+    total = count_rows(path, fmt)
+    started = time.monotonic()
+    items = itertools.islice(read_rows(path, fmt, batch_size), done, None)
+    imported = 0
+    while True:
+        batch = [coerce(model, item, done + number)
+                 for number, item in enumerate(
+                     itertools.islice(items, batch_size), 1)]
+        if not batch:
+            break
+        rows = batch
+        missing = [row for row in batch if row['id'] is None]
+        if resumed:
+            for row, id in zip(missing, state.get('ids', ())):
+                row['id'] = id
+        try:
+            allocate_ids(model, batch)
+        except Exception:
+            db.session.rollback()
+            raise
+        if missing:
+            state['ids'] = [row['id'] for row in missing]
+            save_checkpoint(checkpoint, state)
+        if resumed:
+            # a run stopped between a commit and its checkpoint has
+            # inserted this batch already
+            found = present_ids(model, [row['id'] for row in rows])
+            rows = [row for row in rows if row['id'] not in found]
+            resumed = False
+        if rows:
+            try:
+                insert_batch(model, rows)
+            except IntegrityError as error:
+                raise TransferError(
+                    f'rows {done + 1} to {done + len(batch)} of {path}: '
+                    f'{error.orig}') from error
+        done += len(batch)
+        imported += len(rows)
+        state['rows'] = done
+        state.pop('ids', None)
+        save_checkpoint(checkpoint, state)
+        progress(table, done, total, time.monotonic() - started)
+    clear_checkpoint(checkpoint)
+    return imported
+
+
+# Writing files
+
+class FileWriter:
+    '''
+    Appends rows to a CSV or NDJSON file. A resumed export truncates
+    the file to the offset of its checkpoint, so rows written after it
+    are not repeated.
+    '''
+
+    def __init__(self, path, fmt, fields, offset=None):
+        self.fmt = fmt
+        self.fields = fields
+        if offset is None:
+            self.raw = open(path, 'wb')
+        else:
+            self.raw = open(path, 'r+b')
+            self.raw.truncate(offset)
+            self.raw.seek(offset)
+        self.file = io.TextIOWrapper(self.raw, encoding='utf-8',
+                                     newline='')
+        self.csv = csv.writer(self.file, lineterminator='\n')
+        if fmt == 'csv' and offset is None:
+            self.csv.writerow(fields)
+
+    def write(self, rows):
+        if self.fmt == 'csv':
+            self.csv.writerows([row[field] for field in self.fields]
+                               for row in rows)
+        else:
+            self.file.writelines(json.dumps(row) + '\n' for row in rows)
+
+    def copy(self, query):
+        '''
+        Writes the result of a query straight from COPY TO STDOUT.
+        Returns the number of rows.
+        '''
+        self.file.flush()
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(f'COPY ({query}) TO STDOUT WITH (FORMAT csv)',
+                           self.raw)
+        return cursor.rowcount
+
+    def offset(self):
+        self.file.flush()
+        return self.raw.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    '''
+    Writes every batch as a row group of a Parquet file. The footer is
+    only written by close(), so exports to Parquet can't be resumed.
+    '''
+
+    def __init__(self, model, path):
+        types = {int: pyarrow.int64(), str: pyarrow.string()}
+        self.schema = pyarrow.schema([
+            (field, types[model.__table__.c[field].type.python_type])
+            for field in model.FIELDS])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        self.writer.write_table(pyarrow.Table.from_pylist(rows,
+                                                          self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def export_select(model, after, upto=None, limit=None):
+    table = model.__table__
+    query = select([table.c[field] for field in model.FIELDS]) \
+        .where(table.c.id > after).order_by(table.c.id)
+    if 'deleted_at' in table.c:
+        query = query.where(live(model))
+    if upto is not None:
+        query = query.where(table.c.id <= upto)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def export_batch(model, writer, after, batch_size, use_copy):
+    '''
+    Writes the next batch of rows after the id `after`. Returns the
+    rows written and the last id.
+    '''
+    if use_copy:
+        page = export_select(model, after, limit=batch_size).alias()
+        upto = db.session.execute(select([func.max(page.c.id)])).scalar()
+        if upto is None:
+            return 0, after
+        query = export_select(model, after, upto).compile(
+            db.session.get_bind(), compile_kwargs={'literal_binds': True})
+        return writer.copy(query), upto
+    rows = [dict(zip(model.FIELDS, row)) for row in db.session.execute(
+        export_select(model, after, limit=batch_size))]
+    if not rows:
+        return 0, after
+    writer.write(rows)
+    return len(rows), rows[-1]['id']
+
+
+@file_errors
+def export_file(table, path, fmt=None, batch_size=TRANSFER_BATCH_SIZE,
+                checkpoint=None, restart=False, progress=report):
+    '''
+    Exports the rows of `table`, soft deleted ones excluded, in id
+    order. CSV and NDJSON exports resume from their checkpoint unless
+    `restart` is set. Returns the rows written by this run.
+    '''
+    model = TABLES[table]
+    fmt = file_format(path, fmt)
+    checkpoint = checkpoint or path + '.checkpoint'
+    if restart or fmt == 'parquet':
+        clear_checkpoint(checkpoint)
+    state = load_checkpoint(checkpoint, table)
+    if fmt == 'parquet':
+        writer = ParquetWriter(model, path)
+    else:
+        writer = FileWriter(path, fmt, model.FIELDS,
+                            state and state['offset'])
+    state = state or {'table': table, 'rows': 0, 'after': 0}
+    use_copy = fmt == 'csv' and is_postgresql()
+    started = time.monotonic()
+    exported = 0
+    try:
+        while True:
+            count, state['after'] = export_batch(
+                model, writer, state['after'], batch_size, use_copy)
+            if not count:
+                break
+            state['rows'] += count
+            exported += count
+            if fmt != 'parquet':
+                state['offset'] = writer.offset()
+                save_checkpoint(checkpoint, state)
+            progress(table, state['rows'], None,
+                     time.monotonic() - started)
+    finally:
+        writer.close()
+    clear_checkpoint(checkpoint)
+    return exported
+
+
+# Commands
+
+def transfer_options(command):
+    for option in reversed((
+            click.argument('table', type=click.Choice(sorted(TABLES))),
+            click.argument('path'),
+            click.option('-f', '--format', 'fmt', type=click.Choice(FORMATS),
+                         help='file format, by default from the file '
+                              'extension'),
+            click.option('-b', '--batch-size', type=int,
+                         default=TRANSFER_BATCH_SIZE),
+            click.option('--checkpoint',
+                         help='checkpoint file, by default '
+                              '<path>.checkpoint'),
+            click.option('--restart', is_flag=True,
+                         help='ignore the checkpoint of an earlier run'))):
+        command = option(command)
+    return command
+
+
+@click.command('import')
+@transfer_options
+@with_appcontext
+def import_command(table, path, fmt, batch_size, checkpoint, restart):
+    '''
+    Imports a CSV, NDJSON or Parquet file into a table.
+    '''
+    try:
+        rows = import_file(table, path, fmt, batch_size, checkpoint, restart)
+    except TransferError as error:
+        raise click.ClickException(str(error))
+    click.echo(f'imported {rows} {table}')
+
+
+@click.command('export')
+@transfer_options
+@with_appcontext
+def export_command(table, path, fmt, batch_size, checkpoint, restart):
+    '''
+    Exports a table to a CSV, NDJSON or Parquet file.
+    '''
+    try:
+        rows = export_file(table, path, fmt, batch_size, checkpoint, restart)
+    except TransferError as error:
+        raise click.ClickException(str(error))
+    click.echo(f'exported {rows} {table}')